@@ -1,14 +1,14 @@
 from typing import Optional
 import math
+import warnings
 from functools import partial
 import numpy as np
 import torch
 from torch import nn
 import torch.nn.functional as F
 from torch.cuda.amp import autocast
-from einops import reduce
 from tqdm.auto import tqdm
-from difs.utils import default, identity, ModelPrediction
+from difs.utils import exists, default, identity, ModelPrediction
 
 
 def normalize_to_neg_one_to_one(img):
@@ -21,28 +21,83 @@ def cosine_t2alpha_cumprod(t):
     return torch.cos((t + 0.008)/1.008 * np.pi/2)**2 / (torch.cos((torch.tensor(0, device=t.device) + 0.008)/1.008 * np.pi/2)**2)   
 
 def extract(a, t, x_shape):
+    if isinstance(t, int):
+        # every sample shares the timestep (sampling loops): a 0-d view broadcasts without a gather
+        return a[t]
     b, *_ = t.shape
     out = a.gather(-1, t)
     return out.reshape(b, *((1,) * (len(x_shape) - 1)))
 
-def linear_beta_schedule(timesteps):
+def extract_pair(a, t, x_shape):
+    # a is a (T, 2) table of coefficients read together; one index fetches both columns
+    if isinstance(t, int):
+        return a[t].unbind(-1)
+    b, *_ = t.shape
+    out = a.index_select(0, t)
+    return out.reshape(b, 2, *((1,) * (len(x_shape) - 1))).unbind(1)
+
+# fused elementwise sampler updates, scripted so the fuser emits a single kernel per step
+
+def ddim_step(x_start: torch.Tensor, pred_noise: torch.Tensor, noise: torch.Tensor,
+              sqrt_alpha_next: float, c: float, sigma: float) -> torch.Tensor:
+    return x_start * sqrt_alpha_next + c * pred_noise + sigma * noise
+
+def p_sample_step(model_mean: torch.Tensor, model_log_variance: torch.Tensor, noise: torch.Tensor) -> torch.Tensor:
+    return model_mean + (0.5 * model_log_variance).exp() * noise
+
+def dpmpp_2m_step(img: torch.Tensor, x_start: torch.Tensor, x_start_prev: torch.Tensor,
+                  sigma_ratio: float, data_coef: float, half_inv_r: float) -> torch.Tensor:
+    return img * sigma_ratio + data_coef * ((1. + half_inv_r) * x_start - half_inv_r * x_start_prev)
+
+try:
+    ddim_step, p_sample_step, dpmpp_2m_step = map(torch.jit.script, (ddim_step, p_sample_step, dpmpp_2m_step))
+except Exception:
+    pass
+
+# with PYTORCH_JIT=0 script() hands back the python function, so check what we actually got
+SCRIPTED_STEPS = isinstance(ddim_step, torch.jit.ScriptFunction)
+
+def ddim_step_(x_start: torch.Tensor, pred_noise: torch.Tensor, noise: torch.Tensor,
+               sqrt_alpha_next: float, c: float, sigma: float) -> torch.Tensor:
+    # unfused fallback: build the update in the freshly predicted x_start instead of a new tensor
+    return x_start.mul_(sqrt_alpha_next).add_(pred_noise, alpha=c).add_(noise, alpha=sigma)
+
+def p_sample_step_(model_mean: torch.Tensor, model_log_variance: torch.Tensor, noise: torch.Tensor) -> torch.Tensor:
+    # unfused fallback: model_mean is freshly built by q_posterior, so the noise is added into it directly
+    return model_mean.addcmul_((0.5 * model_log_variance).exp_(), noise)
+
+def linear_beta_schedule(timesteps, device='cpu', dtype=torch.float32):
     scale = 1000 / timesteps
     beta_start = scale * 0.0001
     beta_end = scale * 0.02
-    return torch.linspace(beta_start, beta_end, timesteps, dtype=torch.float64)
+    return torch.linspace(beta_start, beta_end, timesteps, device=device, dtype=dtype)
 
-def cosine_beta_schedule(timesteps, s=0.008):
+def cosine_beta_schedule(timesteps, s=0.008, device='cpu', dtype=torch.float32):
     """
     cosine schedule
     as proposed in https://openreview.net/forum?id=-NEXDKk8gZ
     """
     steps = timesteps + 1
-    x = torch.linspace(0, timesteps, steps, dtype=torch.float64)
+    x = torch.linspace(0, timesteps, steps, device=device, dtype=dtype)
     alphas_cumprod = torch.cos(((x / timesteps) + s) / (1 + s) * math.pi * 0.5) ** 2
     alphas_cumprod = alphas_cumprod / alphas_cumprod[0]
     betas = 1 - (alphas_cumprod[1:] / alphas_cumprod[:-1])
     return torch.clip(betas, 0, 0.999)
 
+def rebuild_derived_schedule(module, incompatible_keys):
+    # load_state_dict post hook
+    module._register_derived_schedule()
+
+class ConditionalForward(nn.Module):
+    """ the denoiser's conditional forward (no conditioning dropout) with a plain positional signature for tracing """
+
+    def __init__(self, model):
+        super().__init__()
+        self.model = model
+
+    def forward(self, x, t, cond, inits):
+        return self.model(x, t, cond, inits, cond_drop_prob=0.)
+
 class GaussianDiffusionConditional(nn.Module):
     def __init__(
         self,
@@ -60,10 +115,31 @@ class GaussianDiffusionConditional(nn.Module):
         clip_max: float = 5.,
         cfg_drop_prob: float = 0.1,
         # guidance scale typically between 1 and 10
-        cfg_guidance_scale: float = 1.0
+        cfg_guidance_scale: float = 1.0,
+        compile_model: bool = False,
+        compile_mode: str = 'reduce-overhead',
+        # dtype the denoiser runs in while sampling on cuda, e.g. torch.float16 or torch.bfloat16
+        sample_dtype: torch.dtype = torch.float32,
+        # replay each ancestral sampling step from a captured CUDA graph
+        cuda_graph: bool = False,
+        # one of 'ddpm', 'ddim', 'dpmpp_2m'; defaults to ddim when sampling_timesteps < timesteps, else ddpm
+        sampler: Optional[str] = None,
+        # trace the denoiser with torch.jit.trace on the first sampling call
+        jit: bool = False,
+        # build the noise schedule in float64 on cpu (the original path); False builds it in float32 on the
+        # model's device, faster to construct but ~0.1% off where 1 - alphas_cumprod cancels at small t
+        precise_schedule: bool = True
     ):
         super().__init__()
+        assert not (jit and compile_model), 'jit tracing and torch.compile are alternatives, enable at most one'
         self.model = model
+        if compile_model:
+            if hasattr(self.model, 'enable_compile'):
+                # the model compiles its network body, which forward and the forward_with_cond_scale passes all run
+                self.model.enable_compile(compile_mode, fullgraph=False)
+            else:
+                # any other denoiser has its __call__ compiled in place, which keeps its state dict keys
+                self.model.compile(mode=compile_mode, dynamic=False)
         self.channels = self.model.channels
         self.cond_dim = self.model.cond_dim
         self.self_condition = False
@@ -74,14 +150,32 @@ class GaussianDiffusionConditional(nn.Module):
         self.classifier_free_guidance = classifier_free_guidance
         self.drop_prob = cfg_drop_prob
         self.guidance_scale = cfg_guidance_scale
+        self.sample_dtype = sample_dtype
+        self.cuda_graph = cuda_graph
+        self._step_graph = None
+        self._step_graph_key = None
+        self._time_buf = None
+        self._noise_buf = None
+        self.jit = jit
+        self._traced_model = None
+        self._traced_shapes = None
+        self._zeros = {}
+
+        if classifier_free_guidance and cfg_guidance_scale == 1.0:
+            warnings.warn('classifier_free_guidance is enabled with cfg_guidance_scale=1.0, sampling will ignore the unconditional model')
 
         assert objective in {'pred_noise', 'pred_x0', 'pred_v'}, 'objective must be either pred_noise (predict noise) or pred_x0 (predict image start) or pred_v (predict v [v-parameterization as defined in appendix D of progressive distillation paper, used in imagen-video successfully])'
         
         self.beta_schedule = beta_schedule
+        if precise_schedule:
+            schedule_kwargs = dict(device='cpu', dtype=torch.float64)
+        else:
+            schedule_kwargs = dict(device=next(model.parameters()).device, dtype=torch.float32)
+
         if beta_schedule == 'linear':
-            betas = linear_beta_schedule(timesteps)
+            betas = linear_beta_schedule(timesteps, **schedule_kwargs)
         elif beta_schedule == 'cosine':
-            betas = cosine_beta_schedule(timesteps)
+            betas = cosine_beta_schedule(timesteps, **schedule_kwargs)
         else:
             raise ValueError(f'unknown beta schedule {beta_schedule}')
 
@@ -98,9 +192,11 @@ class GaussianDiffusionConditional(nn.Module):
         assert self.sampling_timesteps <= timesteps
         self.is_ddim_sampling = self.sampling_timesteps < timesteps
         self.ddim_sampling_eta = ddim_sampling_eta
+        self.sampler = default(sampler, 'ddim' if self.is_ddim_sampling else 'ddpm')
+        assert self.sampler in {'ddpm', 'ddim', 'dpmpp_2m'}, 'sampler must be one of ddpm, ddim or dpmpp_2m'
 
-        # helper function to register buffer from float64 to float32
-        register_buffer = lambda name, val: self.register_buffer(name, val.to(torch.float32))
+        # helper function to register buffer as float32, casting only the precise (float64) schedule
+        register_buffer = lambda name, val: self.register_buffer(name, val if val.dtype == torch.float32 else val.to(torch.float32))
 
         register_buffer('betas', betas)
         register_buffer('alphas_cumprod', alphas_cumprod)
@@ -136,12 +232,74 @@ class GaussianDiffusionConditional(nn.Module):
 
         register_buffer('loss_weight', loss_weight)
 
+        self._register_derived_schedule()
+        # a checkpoint's schedule buffers replace the ones built above, so rebuild the tables derived from them
+        self.register_load_state_dict_post_hook(rebuild_derived_schedule)
+
         # whether to autonormalize
         self.normalize = normalize_to_neg_one_to_one if auto_normalize else identity
         self.unnormalize = unnormalize_to_zero_to_one if auto_normalize else identity
         self.clip_min = clip_min
         self.clip_max = clip_max
 
+    def _register_derived_schedule(self):
+        # non-persistent tables computed from the schedule buffers, so the state dict keeps the layout above
+
+        # co-accessed coefficients packed as (T, 2) so each lookup is a single index_select
+        self.register_buffer('sqrt_alphas_cumprod_pair', torch.stack((self.sqrt_alphas_cumprod, self.sqrt_one_minus_alphas_cumprod), dim=-1), persistent=False)
+        self.register_buffer('posterior_mean_coef_pair', torch.stack((self.posterior_mean_coef1, self.posterior_mean_coef2), dim=-1), persistent=False)
+
+        # the DDIM schedule only depends on (num_timesteps, sampling_timesteps, eta), so build it once
+        self.ddim_time_pairs, ddim_sqrt_alpha_next, ddim_sigma, ddim_c = self._build_ddim_schedule(self.num_timesteps, self.sampling_timesteps)
+        self.register_buffer('ddim_sqrt_alpha_next', ddim_sqrt_alpha_next, persistent=False)
+        self.register_buffer('ddim_sigma', ddim_sigma, persistent=False)
+        self.register_buffer('ddim_c', ddim_c, persistent=False)
+
+        _, dpm_sigma_ratio, dpm_data_coef, dpm_half_inv_r = self._build_dpmpp_schedule(self.num_timesteps, self.sampling_timesteps)
+        self.register_buffer('dpm_sigma_ratio', dpm_sigma_ratio, persistent=False)
+        self.register_buffer('dpm_data_coef', dpm_data_coef, persistent=False)
+        self.register_buffer('dpm_half_inv_r', dpm_half_inv_r, persistent=False)
+
+    def _sampling_time_pairs(self, total_timesteps, sampling_timesteps):
+        times = torch.linspace(-1, total_timesteps - 1, steps=sampling_timesteps + 1)   # [-1, 0, 1, 2, ..., T-1] when sampling_timesteps == total_timesteps
+        times = list(reversed(times.int().tolist()))
+        time_pairs = list(zip(times[:-1], times[1:])) # [(T-1, T-2), (T-2, T-3), ..., (1, 0), (0, -1)]
+
+        # the clamped (0, -1) entry is unused, that step returns x_start
+        time, time_next = map(lambda ts: torch.tensor(ts, device=self.alphas_cumprod.device).clamp(min=0), zip(*time_pairs))
+        return time_pairs, time, time_next
+
+    def _build_ddim_schedule(self, total_timesteps, sampling_timesteps):
+        time_pairs, time, time_next = self._sampling_time_pairs(total_timesteps, sampling_timesteps)
+        alpha = self.alphas_cumprod[time]
+        alpha_next = self.alphas_cumprod[time_next]
+
+        sigma = self.ddim_sampling_eta * ((1 - alpha / alpha_next) * (1 - alpha_next) / (1 - alpha)).sqrt()
+        c = (1 - alpha_next - sigma ** 2).sqrt()
+        return time_pairs, alpha_next.sqrt(), sigma, c
+
+    def _build_dpmpp_schedule(self, total_timesteps, sampling_timesteps):
+        """
+        DPM-Solver++(2M) coefficients (Lu et al. 2022) in data prediction form, x_s -> x_t:
+            h = lambda_t - lambda_s,  lambda = log(alpha / sigma)
+            x_t = (sigma_t / sigma_s) * x_s - alpha_t * expm1(-h) * D
+            D = (1 + 1 / 2r) * x0_s - (1 / 2r) * x0_prev,  r = h_prev / h
+        with alpha = sqrt(alphas_cumprod), sigma = sqrt(1 - alphas_cumprod).
+        """
+        time_pairs, time, time_next = self._sampling_time_pairs(total_timesteps, sampling_timesteps)
+        alphas_cumprod = self.alphas_cumprod.double()
+        alpha, alpha_next = alphas_cumprod[time].sqrt(), alphas_cumprod[time_next].sqrt()
+        sigma, sigma_next = (1 - alphas_cumprod[time]).sqrt(), (1 - alphas_cumprod[time_next]).sqrt()
+
+        h = torch.log(alpha_next / sigma_next) - torch.log(alpha / sigma)
+        sigma_ratio = sigma_next / sigma
+        data_coef = -alpha_next * torch.expm1(-h)
+
+        # the first step has no history and takes a first-order (DDIM) step
+        half_inv_r = torch.zeros_like(h)
+        half_inv_r[1:] = 0.5 * h[1:] / h[:-1]
+        return time_pairs, sigma_ratio.float(), data_coef.float(), half_inv_r.float()
+
     def predict_start_from_noise(self, x_t, t, noise):
         return (
             extract(self.sqrt_recip_alphas_cumprod, t, x_t.shape) * x_t -
@@ -155,33 +313,102 @@ class GaussianDiffusionConditional(nn.Module):
         )
 
     def predict_v(self, x_start, t, noise):
-        return (
-            extract(self.sqrt_alphas_cumprod, t, x_start.shape) * noise -
-            extract(self.sqrt_one_minus_alphas_cumprod, t, x_start.shape) * x_start
-        )
+        sqrt_alphas_cumprod, sqrt_one_minus_alphas_cumprod = extract_pair(self.sqrt_alphas_cumprod_pair, t, x_start.shape)
+        return sqrt_alphas_cumprod * noise - sqrt_one_minus_alphas_cumprod * x_start
 
     def predict_start_from_v(self, x_t, t, v):
-        return (
-            extract(self.sqrt_alphas_cumprod, t, x_t.shape) * x_t -
-            extract(self.sqrt_one_minus_alphas_cumprod, t, x_t.shape) * v
-        )
+        sqrt_alphas_cumprod, sqrt_one_minus_alphas_cumprod = extract_pair(self.sqrt_alphas_cumprod_pair, t, x_t.shape)
+        return sqrt_alphas_cumprod * x_t - sqrt_one_minus_alphas_cumprod * v
 
     def q_posterior(self, x_start, x_t, t):
-        posterior_mean = (
-            extract(self.posterior_mean_coef1, t, x_t.shape) * x_start +
-            extract(self.posterior_mean_coef2, t, x_t.shape) * x_t
-        )
+        posterior_mean_coef1, posterior_mean_coef2 = extract_pair(self.posterior_mean_coef_pair, t, x_t.shape)
+        posterior_mean = posterior_mean_coef1 * x_start + posterior_mean_coef2 * x_t
         posterior_variance = extract(self.posterior_variance, t, x_t.shape)
         posterior_log_variance_clipped = extract(self.posterior_log_variance_clipped, t, x_t.shape)
         return posterior_mean, posterior_variance, posterior_log_variance_clipped
 
+    def _batched_times(self, t: int, x):
+        # with grad on, the time embedding may save this tensor for backward, so it must not be refilled in place
+        if torch.is_grad_enabled():
+            return torch.full((x.shape[0],), t, device=x.device, dtype=torch.long)
+        # refill one persistent device buffer rather than allocating a time tensor every sampler step
+        if self._time_buf is None or self._time_buf.shape[0] != x.shape[0] or self._time_buf.device != x.device:
+            self._time_buf = torch.empty(x.shape[0], device=x.device, dtype=torch.long)
+        return self._time_buf.fill_(t)
+
+    def _cached_zeros(self, like):
+        # the unguided conditioning never changes, so keep one zero tensor per shape/device/dtype.
+        # entries are never replaced: a captured step graph keeps reading the memory of the one it recorded
+        key = (like.shape, like.device, like.dtype)
+        if key not in self._zeros:
+            self._zeros[key] = torch.zeros_like(like)
+        return self._zeros[key]
+
+    def _noise_like(self, x):
+        # refill one buffer in place; each step consumes the noise before the next step overwrites it
+        if self._noise_buf is None or self._noise_buf.shape != x.shape or self._noise_buf.device != x.device or self._noise_buf.dtype != x.dtype:
+            self._noise_buf = torch.empty_like(x)
+        return self._noise_buf.normal_()
+
+    def jit_trace(self, example_x, example_t, example_cond, example_inits):
+        """
+        Traces the denoiser's conditional forward for sampling. The traced graph is tied to the
+        example shapes, so model_predictions re-traces when they change. With classifier-free
+        guidance the guided and unguided passes share one doubled batch, so a single trace
+        covers both. Falls back to the eager model if tracing fails.
+        """
+        try:
+            with torch.no_grad():
+                traced = torch.jit.trace(ConditionalForward(self.model), (example_x, example_t, example_cond, example_inits), check_trace=False)
+        except Exception as e:
+            warnings.warn(f'jit tracing the denoiser failed, falling back to eager: {e}')
+            self.jit = False
+            return
+        # kept outside the module tree so the traced copy never shows up in state_dict
+        object.__setattr__(self, '_traced_model', traced)
+        self._traced_shapes = (example_x.shape, example_t.shape, example_cond.shape, example_inits.shape)
+
+    def _cond_proj(self, cond, inits):
+        # the fixed conditioning's share of every resnet block's scale/shift mlp, computed once per sampling loop.
+        # built for the same (possibly doubled) batch model_predictions feeds the model; the traced graph takes none
+        if self.jit:
+            return None
+        if self.classifier_free_guidance and self.guidance_scale != 1.0:
+            cond = torch.cat((cond, self._cached_zeros(cond)))
+            inits = torch.cat((inits, self._cached_zeros(inits)))
+        return self.model.precompute_cond(cond, inits)
+
+    def _denoise(self, x, t, cond, inits, cond_scale, rescaled_phi, cond_proj=None):
+        # the traced graph is the cond_drop_prob=0 forward, which is all forward_with_cond_scale runs at cond_scale 1
+        if self.jit and cond_scale == 1:
+            if self._traced_shapes != (x.shape, t.shape, cond.shape, inits.shape):
+                self.jit_trace(x, t, cond, inits)
+            if self.jit:
+                return self._traced_model(x, t, cond, inits)
+        return self.model.forward_with_cond_scale(x, t, cond, inits, cond_scale=cond_scale, rescaled_phi=rescaled_phi, cond_proj=cond_proj)
+
     def model_predictions(self, x, t, cond, inits, cond_scale=1., rescaled_phi=0.0, 
-                            clip_x_start=False, rederive_pred_noise = False):
-        model_output = self.model.forward_with_cond_scale(x, t, cond, inits, cond_scale=cond_scale, rescaled_phi=rescaled_phi)
-        
-        if self.classifier_free_guidance:
-            model_output_unguided = self.model.forward_with_cond_scale(x, t, torch.zeros_like(cond), torch.zeros_like(inits),
-                                                                        cond_scale=cond_scale, rescaled_phi=rescaled_phi)
+                            clip_x_start=False, rederive_pred_noise = False, cond_proj=None):
+        # t may be a python int when the whole batch shares the timestep; the model still needs one per sample
+        model_t = self._batched_times(t, x) if isinstance(t, int) else t
+
+        # with a guidance scale of 1 the guided combination reduces to the conditional output
+        guided = self.classifier_free_guidance and self.guidance_scale != 1.0
+
+        # only the denoiser runs in reduced precision, the schedule arithmetic below stays in x.dtype
+        with torch.autocast('cuda', dtype=self.sample_dtype, enabled=x.is_cuda and self.sample_dtype != torch.float32):
+            if guided:
+                # run the guided and unguided passes as one doubled batch instead of two forwards
+                model_output = self._denoise(
+                    torch.cat((x, x)), torch.cat((model_t, model_t)),
+                    torch.cat((cond, self._cached_zeros(cond))), torch.cat((inits, self._cached_zeros(inits))),
+                    cond_scale, rescaled_phi, cond_proj)
+            else:
+                model_output = self._denoise(x, model_t, cond, inits, cond_scale, rescaled_phi, cond_proj)
+        model_output = model_output.to(x.dtype)
+
+        if guided:
+            model_output, model_output_unguided = model_output.chunk(2)
             model_output = model_output_unguided + self.guidance_scale * (model_output - model_output_unguided)
         
         maybe_clip = partial(torch.clamp, min = self.clip_min, max = self.clip_max) if clip_x_start else identity
@@ -207,8 +434,8 @@ class GaussianDiffusionConditional(nn.Module):
 
         return ModelPrediction(pred_noise, x_start)
 
-    def p_mean_variance(self, x, t, cond, inits, cond_scale, rescaled_phi, clip_denoised=True):
-        preds = self.model_predictions(x, t, cond, inits, cond_scale, rescaled_phi,)
+    def p_mean_variance(self, x, t, cond, inits, cond_scale, rescaled_phi, clip_denoised=True, cond_proj=None):
+        preds = self.model_predictions(x, t, cond, inits, cond_scale, rescaled_phi, cond_proj=cond_proj)
         x_start = preds.pred_x_start
 
         if clip_denoised:
@@ -217,68 +444,166 @@ class GaussianDiffusionConditional(nn.Module):
         model_mean, posterior_variance, posterior_log_variance = self.q_posterior(x_start = x_start, x_t = x, t = t)
         return model_mean, posterior_variance, posterior_log_variance, x_start
 
-    @torch.no_grad()
-    def p_sample(self, x, t: int, cond, inits, cond_scale=1., rescaled_phi=0.0, clip_denoised=True):
-        b, *_, device = *x.shape, x.device
-        batched_times = torch.full((b,), t, device = x.device, dtype = torch.long)
-        model_mean, _, model_log_variance, x_start = self.p_mean_variance(x=x, t=batched_times, cond=cond, inits=inits, cond_scale=cond_scale, rescaled_phi=rescaled_phi, clip_denoised=clip_denoised)
-        noise = torch.randn_like(x) if t > 0 else 0. # no noise if t == 0
-        pred_img = model_mean + (0.5 * model_log_variance).exp() * noise
+    def p_sample(self, x, t: int, cond, inits, cond_scale=1., rescaled_phi=0.0, clip_denoised=True, cond_proj=None):
+        model_mean, _, model_log_variance, x_start = self.p_mean_variance(x=x, t=t, cond=cond, inits=inits, cond_scale=cond_scale, rescaled_phi=rescaled_phi,
+                                                                          clip_denoised=clip_denoised, cond_proj=cond_proj)
+        # no noise if t == 0
+        if t == 0:
+            pred_img = model_mean
+        elif SCRIPTED_STEPS or torch.is_grad_enabled():
+            pred_img = p_sample_step(model_mean, model_log_variance, self._noise_like(x))
+        else:
+            pred_img = p_sample_step_(model_mean, model_log_variance, self._noise_like(x))
         return pred_img, x_start
 
-    @torch.no_grad()
     def p_sample_loop(self, shape, cond, inits, cond_scale=1., rescaled_phi=0.0):
         batch, device = shape[0], self.betas.device
 
         img = torch.randn(shape, device=device)
 
+        if self.cuda_graph and device.type == 'cuda' and not torch.is_grad_enabled():
+            return self.p_sample_loop_graphed(img, cond, inits, cond_scale, rescaled_phi)
+
+        cond_proj = self._cond_proj(cond, inits)
+
         for t in tqdm(reversed(range(0, self.num_timesteps)), desc='sampling loop time step', total=self.num_timesteps):
-            img, x_start = self.p_sample(img, t, cond, inits, cond_scale, rescaled_phi)
+            img, x_start = self.p_sample(img, t, cond, inits, cond_scale, rescaled_phi, cond_proj=cond_proj)
 
         img = self.unnormalize(img)
         return img
 
-    @torch.no_grad()
-    def ddim_sample(self, shape, cond, inits, cond_scale=1., rescaled_phi=0.0, clip_denoised=True):
-        batch, device, total_timesteps, sampling_timesteps, eta, objective = shape[0], self.betas.device, self.num_timesteps, self.sampling_timesteps, self.ddim_sampling_eta, self.objective
+    def _step_graph_signature(self, shape, cond, inits, cond_scale, rescaled_phi):
+        # everything the captured step bakes in as a python constant, so changing any of it re-captures
+        return (tuple(shape), cond.shape, inits.shape, cond_scale, rescaled_phi, self.classifier_free_guidance,
+                self.guidance_scale, self.sample_dtype, self.betas.device)
 
-        times = torch.linspace(-1, total_timesteps - 1, steps=sampling_timesteps + 1)   # [-1, 0, 1, 2, ..., T-1] when sampling_timesteps == total_timesteps
-        times = list(reversed(times.int().tolist()))
-        time_pairs = list(zip(times[:-1], times[1:])) # [(T-1, T-2), (T-2, T-3), ..., (1, 0), (0, -1)]
+    def _capture_step_graph(self, shape, cond, inits, cond_scale, rescaled_phi):
+        """
+        Captures one noisy (t > 0) p_sample step into a CUDA graph over static buffers.
+        The timestep is read from a device tensor, so a single graph replays for every t > 0.
+        """
+        # CUDA graphs do not nest, so the denoiser must not replay a graph of its own inside the step
+        assert not exists(getattr(self.model, '_graph', None)), 'cuda_graph sampling needs a denoiser without its own captured graph (Unet.capture)'
+        compile_kwargs = getattr(self.model, 'compile_kwargs', None)
+        assert not (exists(compile_kwargs) and compile_kwargs.get('mode') in ('reduce-overhead', 'max-autotune')), \
+            f"cuda_graph sampling cannot wrap a model compiled with mode='{compile_kwargs['mode']}', which runs its own CUDA graphs"
+        device = self.betas.device
+        self._g_img = torch.randn(shape, device=device)
+        self._g_t = torch.full((shape[0],), self.num_timesteps - 1, device=device, dtype=torch.long)
+        self._g_cond, self._g_inits = cond.clone(), inits.clone()
+
+        def step():
+            model_mean, _, model_log_variance, _ = self.p_mean_variance(x=self._g_img, t=self._g_t, cond=self._g_cond, inits=self._g_inits,
+                                                                        cond_scale=cond_scale, rescaled_phi=rescaled_phi)
+            return p_sample_step(model_mean, model_log_variance, torch.randn_like(self._g_img))
 
-        img = torch.randn(shape, device=device)
+        # warm up on a side stream so lazy initialisation and the script fuser's profiling runs are not recorded
+        stream = torch.cuda.Stream()
+        stream.wait_stream(torch.cuda.current_stream())
+        with torch.cuda.stream(stream):
+            for _ in range(3):
+                step()
+        torch.cuda.current_stream().wait_stream(stream)
 
-        x_start = None
+        self._step_graph = torch.cuda.CUDAGraph()
+        with torch.cuda.graph(self._step_graph):
+            self._g_out = step()
+        self._step_graph_key = self._step_graph_signature(shape, cond, inits, cond_scale, rescaled_phi)
+
+    def p_sample_loop_graphed(self, img, cond, inits, cond_scale=1., rescaled_phi=0.0):
+        if self._step_graph_key != self._step_graph_signature(img.shape, cond, inits, cond_scale, rescaled_phi):
+            self._capture_step_graph(img.shape, cond, inits, cond_scale, rescaled_phi)
+
+        self._g_img.copy_(img)
+        self._g_cond.copy_(cond)
+        self._g_inits.copy_(inits)
+
+        for t in tqdm(reversed(range(1, self.num_timesteps)), desc='sampling loop time step', total=self.num_timesteps - 1):
+            self._g_t.fill_(t)
+            self._step_graph.replay()
+            self._g_img.copy_(self._g_out)
+
+        # the final t == 0 step adds no noise, so it runs eagerly instead of needing a second graph
+        img, _ = self.p_sample(self._g_img, 0, cond, inits, cond_scale, rescaled_phi)
 
-        for time, time_next in tqdm(time_pairs, desc='sampling loop time step'):
-            time_cond = torch.full((batch,), time, device=device, dtype=torch.long)
+        img = self.unnormalize(img)
+        return img
 
-            pred_noise, x_start, *_ = self.model_predictions(img, time_cond, cond, inits, cond_scale, rescaled_phi, clip_x_start = clip_denoised)
+    def ddim_sample(self, shape, cond, inits, cond_scale=1., rescaled_phi=0.0, clip_denoised=True, starting_data = None, starting_timestep=None):
+        batch, device = shape[0], self.betas.device
+
+        if starting_timestep != None:
+            time_pairs, sqrt_alpha_next, sigma, c = self._build_ddim_schedule(starting_timestep, starting_timestep)
+        else:
+            time_pairs, sqrt_alpha_next, sigma, c = self.ddim_time_pairs, self.ddim_sqrt_alpha_next, self.ddim_sigma, self.ddim_c
+        # read the coefficients back once so the loop does no per-step device syncs
+        sqrt_alpha_next, sigma, c = torch.stack((sqrt_alpha_next, sigma, c)).tolist()
+
+        if starting_data == None:
+            img = torch.randn(shape, device=device)
+        else:
+            img = starting_data.to(device)
+
+        x_start = None
+        cond_proj = self._cond_proj(cond, inits)
+
+        for i, (time, time_next) in enumerate(tqdm(time_pairs, desc='sampling loop time step')):
+            pred_noise, x_start, *_ = self.model_predictions(img, time, cond, inits, cond_scale, rescaled_phi, clip_x_start = clip_denoised, cond_proj = cond_proj)
 
             if time_next < 0:
                 img = x_start
                 continue
 
-            alpha = self.alphas_cumprod[time]
-            alpha_next = self.alphas_cumprod[time_next]
+            noise = self._noise_like(img)
+
+            if SCRIPTED_STEPS or torch.is_grad_enabled():
+                img = ddim_step(x_start, pred_noise, noise, sqrt_alpha_next[i], c[i], sigma[i])
+            else:
+                img = ddim_step_(x_start, pred_noise, noise, sqrt_alpha_next[i], c[i], sigma[i])
+
+        img = self.unnormalize(img)
+        return img
 
-            sigma = eta * ((1 - alpha / alpha_next) * (1 - alpha_next) / (1 - alpha)).sqrt()
-            c = (1 - alpha_next - sigma ** 2).sqrt()
+    def dpmpp_sample(self, shape, cond, inits, cond_scale=1., rescaled_phi=0.0, clip_denoised=True, starting_data = None, starting_timestep=None):
+        device = self.betas.device
 
-            noise = torch.randn_like(img)
+        if starting_timestep != None:
+            time_pairs, sigma_ratio, data_coef, half_inv_r = self._build_dpmpp_schedule(starting_timestep, starting_timestep)
+        else:
+            time_pairs, sigma_ratio, data_coef, half_inv_r = self.ddim_time_pairs, self.dpm_sigma_ratio, self.dpm_data_coef, self.dpm_half_inv_r
+        # read the coefficients back once so the loop does no per-step device syncs
+        sigma_ratio, data_coef, half_inv_r = torch.stack((sigma_ratio, data_coef, half_inv_r)).tolist()
+
+        if starting_data == None:
+            img = torch.randn(shape, device=device)
+        else:
+            img = starting_data.to(device)
+
+        x_start = None
+        cond_proj = self._cond_proj(cond, inits)
 
-            img = x_start * alpha_next.sqrt() + \
-                  c * pred_noise + \
-                  sigma * noise
+        for i, (time, time_next) in enumerate(tqdm(time_pairs, desc='sampling loop time step')):
+            x_start_prev = x_start
+            _, x_start, *_ = self.model_predictions(img, time, cond, inits, cond_scale, rescaled_phi, clip_x_start = clip_denoised, cond_proj = cond_proj)
+
+            if time_next < 0:
+                img = x_start
+                continue
+
+            img = dpmpp_2m_step(img, x_start, default(x_start_prev, x_start), sigma_ratio[i], data_coef[i], half_inv_r[i])
 
         img = self.unnormalize(img)
         return img
 
+    @property
+    def sample_fn(self):
+        return {'ddpm': self.p_sample_loop, 'ddim': self.ddim_sample, 'dpmpp_2m': self.dpmpp_sample}[self.sampler]
+
     @torch.no_grad()
     def sample(self, cond, no_grad=True, inits=None, cond_scale=1., rescaled_phi=0.0):
         batch_size = cond.shape[0]
         seq_length, channels = self.seq_length, self.channels
-        sample_fn = self.p_sample_loop if not self.is_ddim_sampling else self.ddim_sample
+        sample_fn = self.sample_fn
         return sample_fn((batch_size, channels, seq_length), cond, inits, cond_scale, rescaled_phi)
 
     @torch.no_grad()
@@ -305,21 +630,20 @@ class GaussianDiffusionConditional(nn.Module):
     def q_sample(self, x_start, t, noise=None):
         noise = default(noise, lambda: torch.randn_like(x_start))
 
-        return (
-            extract(self.sqrt_alphas_cumprod, t, x_start.shape) * x_start +
-            extract(self.sqrt_one_minus_alphas_cumprod, t, x_start.shape) * noise
-        )
+        sqrt_alphas_cumprod, sqrt_one_minus_alphas_cumprod = extract_pair(self.sqrt_alphas_cumprod_pair, t, x_start.shape)
+        return sqrt_alphas_cumprod * x_start + sqrt_one_minus_alphas_cumprod * noise
 
     def p_losses(self, x_start, t, cond, inits, noise=None):
         b, c, n = x_start.shape
         noise = default(noise, lambda: torch.randn_like(x_start))
 
-        # Randomly drop conditioning for classifier-free guidance
+        # Randomly drop conditioning for classifier-free guidance, one draw per sample so a dropped
+        # example sees the all-zero conditioning used by the unguided pass at sampling time
         if self.classifier_free_guidance:
-            cond_mask = torch.rand(cond.shape, device=x_start.device) > self.drop_prob
-            cond = cond * cond_mask  # Mask out conditioning vectors randomly
-            inits_mask = torch.rand(inits.shape, device=x_start.device) > self.drop_prob
-            inits = inits * inits_mask
+            cond_keep = torch.bernoulli(torch.full((b,) + (1,) * (cond.ndim - 1), 1. - self.drop_prob, device=x_start.device))
+            cond = cond * cond_keep
+            inits_keep = torch.bernoulli(torch.full((b,) + (1,) * (inits.ndim - 1), 1. - self.drop_prob, device=x_start.device))
+            inits = inits * inits_keep
 
         # noise sample
         x = self.q_sample(x_start=x_start, t=t, noise=noise)
@@ -338,7 +662,7 @@ class GaussianDiffusionConditional(nn.Module):
             raise ValueError(f'unknown objective {self.objective}')
 
         loss = F.mse_loss(model_out, target, reduction='none')
-        loss = reduce(loss, 'b ... -> b', 'mean')
+        loss = loss.flatten(1).mean(dim=1)
 
         loss = loss * extract(self.loss_weight, t, loss.shape)
         return loss.mean()
@@ -355,238 +679,14 @@ class GaussianDiffusionConditional(nn.Module):
 
 
 
-class GaussianDiffusionConditionalTrainer(nn.Module):
-    def __init__(
-        self,
-        model: nn.Module,
-        seq_length: int,
-        *,
-        timesteps: int = 1000,
-        sampling_timesteps: Optional[int] = None,
-        objective: str = 'pred_v',
-        beta_schedule: str = 'cosine',
-        ddim_sampling_eta: float = 0.,
-        auto_normalize: bool = False,
-        clip_min: float = -5.,
-        clip_max: float = 5.,
-        classifier_free_guidance: bool = False,
-        cfg_guidance_scale: float = 1.0
-    ):
-        super().__init__()
-        self.model = model
-        self.channels = self.model.channels
-        self.cond_dim = self.model.cond_dim
-        self.self_condition = False
-
-        self.seq_length = seq_length
-
-        self.objective = objective
-        self.classifier_free_guidance = classifier_free_guidance
-        self.guidance_scale = cfg_guidance_scale
-
-        assert objective in {'pred_noise', 'pred_x0', 'pred_v'}, 'objective must be either pred_noise (predict noise) or pred_x0 (predict image start) or pred_v (predict v [v-parameterization as defined in appendix D of progressive distillation paper, used in imagen-video successfully])'
-        
-        self.beta_schedule = beta_schedule
-        if beta_schedule == 'linear':
-            betas = linear_beta_schedule(timesteps)
-        elif beta_schedule == 'cosine':
-            betas = cosine_beta_schedule(timesteps)
-        else:
-            raise ValueError(f'unknown beta schedule {beta_schedule}')
-
-        alphas = 1. - betas
-        alphas_cumprod = torch.cumprod(alphas, dim=0)
-        alphas_cumprod_prev = F.pad(alphas_cumprod[:-1], (1, 0), value=1.)
-
-        timesteps, = betas.shape
-        self.num_timesteps = int(timesteps)
-
-        # sampling related parameters
-        self.sampling_timesteps = default(sampling_timesteps, timesteps) # default num sampling timesteps to number of timesteps at training
-
-        assert self.sampling_timesteps <= timesteps
-        self.is_ddim_sampling = self.sampling_timesteps < timesteps
-        self.ddim_sampling_eta = ddim_sampling_eta
-
-        # helper function to register buffer from float64 to float32
-        register_buffer = lambda name, val: self.register_buffer(name, val.to(torch.float32))
-
-        register_buffer('betas', betas)
-        register_buffer('alphas_cumprod', alphas_cumprod)
-        register_buffer('alphas_cumprod_prev', alphas_cumprod_prev)
-
-        # calculations for diffusion q(x_t | x_{t-1}) and others
-        register_buffer('sqrt_alphas_cumprod', torch.sqrt(alphas_cumprod))
-        register_buffer('sqrt_one_minus_alphas_cumprod', torch.sqrt(1. - alphas_cumprod))
-        register_buffer('log_one_minus_alphas_cumprod', torch.log(1. - alphas_cumprod))
-        register_buffer('sqrt_recip_alphas_cumprod', torch.sqrt(1. / alphas_cumprod))
-        register_buffer('sqrt_recipm1_alphas_cumprod', torch.sqrt(1. / alphas_cumprod - 1))
-
-        # calculations for posterior q(x_{t-1} | x_t, x_0)
-        posterior_variance = betas * (1. - alphas_cumprod_prev) / (1. - alphas_cumprod)
-        # above: equal to 1. / (1. / (1. - alpha_cumprod_tm1) + alpha_t / beta_t)
-
-        register_buffer('posterior_variance', posterior_variance)
-
-        # below: log calculation clipped because the posterior variance is 0 at the beginning of the diffusion chain
-        register_buffer('posterior_log_variance_clipped', torch.log(posterior_variance.clamp(min =1e-20)))
-        register_buffer('posterior_mean_coef1', betas * torch.sqrt(alphas_cumprod_prev) / (1. - alphas_cumprod))
-        register_buffer('posterior_mean_coef2', (1. - alphas_cumprod_prev) * torch.sqrt(alphas) / (1. - alphas_cumprod))
-
-        # calculate loss weight
-        snr = alphas_cumprod / (1 - alphas_cumprod)
-
-        if objective == 'pred_noise':
-            loss_weight = torch.ones_like(snr)
-        elif objective == 'pred_x0':
-            loss_weight = snr
-        elif objective == 'pred_v':
-            loss_weight = snr / (snr + 1)
-
-        register_buffer('loss_weight', loss_weight)
-
-        # whether to autonormalize
-        self.normalize = normalize_to_neg_one_to_one if auto_normalize else identity
-        self.unnormalize = unnormalize_to_zero_to_one if auto_normalize else identity
-        self.clip_min = clip_min
-        self.clip_max = clip_max
-
-
-    def predict_start_from_noise(self, x_t, t, noise):
-        return (
-            extract(self.sqrt_recip_alphas_cumprod, t, x_t.shape) * x_t -
-            extract(self.sqrt_recipm1_alphas_cumprod, t, x_t.shape) * noise
-        )
-
-    def predict_noise_from_start(self, x_t, t, x0):
-        return (
-            (extract(self.sqrt_recip_alphas_cumprod, t, x_t.shape) * x_t - x0) / \
-            extract(self.sqrt_recipm1_alphas_cumprod, t, x_t.shape)
-        )
-
-    def predict_v(self, x_start, t, noise):
-        return (
-            extract(self.sqrt_alphas_cumprod, t, x_start.shape) * noise -
-            extract(self.sqrt_one_minus_alphas_cumprod, t, x_start.shape) * x_start
-        )
-
-    def predict_start_from_v(self, x_t, t, v):
-        return (
-            extract(self.sqrt_alphas_cumprod, t, x_t.shape) * x_t -
-            extract(self.sqrt_one_minus_alphas_cumprod, t, x_t.shape) * v
-        )
-
-    def q_posterior(self, x_start, x_t, t):
-        posterior_mean = (
-            extract(self.posterior_mean_coef1, t, x_t.shape) * x_start +
-            extract(self.posterior_mean_coef2, t, x_t.shape) * x_t
-        )
-        posterior_variance = extract(self.posterior_variance, t, x_t.shape)
-        posterior_log_variance_clipped = extract(self.posterior_log_variance_clipped, t, x_t.shape)
-        return posterior_mean, posterior_variance, posterior_log_variance_clipped
-
-    def model_predictions(self, x, t, cond, inits, cond_scale=1., rescaled_phi=0.0, clip_x_start=False, rederive_pred_noise = False):
-        model_output = self.model.forward_with_cond_scale(x, t, cond, inits, cond_scale=cond_scale, rescaled_phi=rescaled_phi)
-        
-        if self.classifier_free_guidance:
-            model_output_unguided = self.model.forward_with_cond_scale(x, t, torch.zeros_like(cond), torch.zeros_like(inits),
-                                                                        cond_scale=cond_scale, rescaled_phi=rescaled_phi)
-            model_output = model_output_unguided + self.guidance_scale * (model_output - model_output_unguided)
-        
-        
-        maybe_clip = partial(torch.clamp, min = self.clip_min, max = self.clip_max) if clip_x_start else identity
-
-        if self.objective == 'pred_noise':
-            pred_noise = model_output
-            x_start = self.predict_start_from_noise(x, t, pred_noise)
-            x_start = maybe_clip(x_start)
-
-            if clip_x_start and rederive_pred_noise:
-                pred_noise = self.predict_noise_from_start(x, t, x_start)
-
-        elif self.objective == 'pred_x0':
-            x_start = model_output
-            x_start = maybe_clip(x_start)
-            pred_noise = self.predict_noise_from_start(x, t, x_start)
-
-        elif self.objective == 'pred_v':
-            v = model_output
-            x_start = self.predict_start_from_v(x, t, v)
-            x_start = maybe_clip(x_start)
-            pred_noise = self.predict_noise_from_start(x, t, x_start)
-
-        return ModelPrediction(pred_noise, x_start)
-
-    def p_mean_variance(self, x, t, cond, inits, cond_scale, rescaled_phi, clip_denoised=True):
-        preds = self.model_predictions(x, t, cond, inits, cond_scale, rescaled_phi,)
-        x_start = preds.pred_x_start
-
-        if clip_denoised:
-            x_start.clamp_(self.clip_min, self.clip_max)
-
-        model_mean, posterior_variance, posterior_log_variance = self.q_posterior(x_start = x_start, x_t = x, t = t)
-        return model_mean, posterior_variance, posterior_log_variance, x_start
-
-    def p_sample(self, x, t: int, cond, inits, cond_scale=1., rescaled_phi=0.0, clip_denoised=True):
-        b, *_, device = *x.shape, x.device
-        batched_times = torch.full((b,), t, device = x.device, dtype = torch.long)
-        model_mean, _, model_log_variance, x_start = self.p_mean_variance(x=x, t=batched_times, cond=cond, inits=inits, cond_scale=cond_scale, rescaled_phi=rescaled_phi, clip_denoised=clip_denoised)
-        noise = torch.randn_like(x) if t > 0 else 0. # no noise if t == 0
-        pred_img = model_mean + (0.5 * model_log_variance).exp() * noise
-        return pred_img, x_start
-
-    def p_sample_loop(self, shape, cond, inits, cond_scale=1., rescaled_phi=0.0):
-        batch, device = shape[0], self.betas.device
-
-        img = torch.randn(shape, device=device)
-
-        for t in tqdm(reversed(range(0, self.num_timesteps)), desc='sampling loop time step', total=self.num_timesteps):
-            img, x_start = self.p_sample(img, t, cond, inits, cond_scale, rescaled_phi)
-
-        img = self.unnormalize(img)
-        return img
-
-    def ddim_sample(self, shape, cond, inits, cond_scale=1., rescaled_phi=0.0, clip_denoised=True, starting_data = None, starting_timestep=None):
-        batch, device, total_timesteps, sampling_timesteps, eta, objective = shape[0], self.betas.device, self.num_timesteps, self.sampling_timesteps, self.ddim_sampling_eta, self.objective
-
-        if starting_timestep != None:
-            total_timesteps = starting_timestep
-            sampling_timesteps = starting_timestep
-
-        times = torch.linspace(-1, total_timesteps - 1, steps=sampling_timesteps + 1)   # [-1, 0, 1, 2, ..., T-1] when sampling_timesteps == total_timesteps
-        times = list(reversed(times.int().tolist()))
-        time_pairs = list(zip(times[:-1], times[1:])) # [(T-1, T-2), (T-2, T-3), ..., (1, 0), (0, -1)]
-
-        if starting_data == None:
-            img = torch.randn(shape, device=device)
-        else:
-            img = starting_data.to(device)
-
-        x_start = None
-
-        for time, time_next in tqdm(time_pairs, desc='sampling loop time step'):
-            time_cond = torch.full((batch,), time, device=device, dtype=torch.long)
-
-            pred_noise, x_start, *_ = self.model_predictions(img, time_cond, cond, inits, cond_scale, rescaled_phi, clip_x_start = clip_denoised)
-
-            if time_next < 0:
-                img = x_start
-                continue
-
-            alpha = self.alphas_cumprod[time]
-            alpha_next = self.alphas_cumprod[time_next]
-
-            sigma = eta * ((1 - alpha / alpha_next) * (1 - alpha_next) / (1 - alpha)).sqrt()
-            c = (1 - alpha_next - sigma ** 2).sqrt()
-
-            noise = torch.randn_like(img)
-
-            img = x_start * alpha_next.sqrt() + \
-                  c * pred_noise + \
-                  sigma * noise
+class GaussianDiffusionConditionalTrainer(GaussianDiffusionConditional):
+    """
+    Diffusion wrapper whose sampling keeps gradients unless no_grad is set, with partial-trajectory
+    inference and forward diffusion helpers. forward() draws samples instead of returning the loss.
+    """
 
-        img = self.unnormalize(img)
-        return img
+    def __init__(self, model: nn.Module, seq_length: int, *, classifier_free_guidance: bool = False, **kwargs):
+        super().__init__(model, seq_length, classifier_free_guidance, **kwargs)
 
     def sample(self, cond, no_grad=False, inits=None, cond_scale=1., rescaled_phi=0.0):
         if no_grad:
@@ -594,14 +694,14 @@ class GaussianDiffusionConditionalTrainer(nn.Module):
                 print("Gradients turned off")
                 batch_size = cond.shape[0]
                 seq_length, channels = self.seq_length, self.channels
-                sample_fn = self.p_sample_loop if not self.is_ddim_sampling else self.ddim_sample
+                sample_fn = self.sample_fn
                 samples = sample_fn((batch_size, channels, seq_length), cond, inits, cond_scale, rescaled_phi)
 
                 return samples
 
         batch_size = cond.shape[0]
         seq_length, channels = self.seq_length, self.channels
-        sample_fn = self.p_sample_loop if not self.is_ddim_sampling else self.ddim_sample
+        sample_fn = self.sample_fn
         samples = sample_fn((batch_size, channels, seq_length), cond, inits, cond_scale, rescaled_phi)
 
         return samples
@@ -615,31 +715,34 @@ class GaussianDiffusionConditionalTrainer(nn.Module):
         """
 
         batch, device = cond.shape[0], self.betas.device
+        partial_sample_fn = self.dpmpp_sample if self.sampler == 'dpmpp_2m' else self.ddim_sample
         
         if no_grad:
             with torch.no_grad():
                 if starting_timestep < self.betas.shape[0]:
-                    return self.ddim_sample(starting_data=starting_data.to(device), starting_timestep=starting_timestep,
-                                            shape=(batch, self.channels, self.seq_length),
-                                            cond=cond, inits=inits, cond_scale=cond_scale, rescaled_phi=rescaled_phi)
+                    return partial_sample_fn(starting_data=starting_data.to(device), starting_timestep=starting_timestep,
+                                             shape=(batch, self.channels, self.seq_length),
+                                             cond=cond, inits=inits, cond_scale=cond_scale, rescaled_phi=rescaled_phi)
 
                 img = starting_data.to(device)
+                cond_proj = self._cond_proj(cond, inits)
 
                 for t in tqdm(reversed(range(0, starting_timestep)), desc='sampling loop time step', total=starting_timestep):
-                    img = self.p_sample(img, t, cond, inits, cond_scale, rescaled_phi)[0]
+                    img = self.p_sample(img, t, cond, inits, cond_scale, rescaled_phi, cond_proj=cond_proj)[0]
 
                 img = self.unnormalize(img)
                 return img
         
         if starting_timestep < self.betas.shape[0]:
-            return self.ddim_sample(starting_data=starting_data.to(device), starting_timestep=starting_timestep,
-                                    shape=(batch, self.channels, self.seq_length),
-                                    cond=cond, inits=inits, cond_scale=cond_scale, rescaled_phi=rescaled_phi)
+            return partial_sample_fn(starting_data=starting_data.to(device), starting_timestep=starting_timestep,
+                                     shape=(batch, self.channels, self.seq_length),
+                                     cond=cond, inits=inits, cond_scale=cond_scale, rescaled_phi=rescaled_phi)
 
         img = starting_data.to(device)
+        cond_proj = self._cond_proj(cond, inits)
 
         for t in tqdm(reversed(range(0, starting_timestep)), desc='sampling loop time step', total=starting_timestep):
-            img = self.p_sample(img, t, cond, inits, cond_scale, rescaled_phi)[0]
+            img = self.p_sample(img, t, cond, inits, cond_scale, rescaled_phi, cond_proj=cond_proj)[0]
 
         img = self.unnormalize(img)
         return img
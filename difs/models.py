@@ -1,11 +1,12 @@
 
 import math
+from contextlib import nullcontext
 from functools import partial
+from typing import Final, Optional, Tuple
 import torch
-from torch import nn, einsum
+from torch import nn
 import torch.nn.functional as F
-from einops import rearrange, repeat
-from difs.utils import exists, default, prob_mask_like
+from difs.utils import exists, default, prob_mask_like, compiled, raise_compile_cache_limit
 
 
 # small helper modules
@@ -17,7 +18,14 @@ class Residual(nn.Module):
     def forward(self, x, *args, **kwargs):
         return self.fn(x, *args, **kwargs) + x
 
-def Upsample(dim, dim_out = None):
+def Upsample(dim, dim_out = None, separable = False):
+    if separable:
+        # depthwise 3-tap conv followed by a pointwise 1x1
+        return nn.Sequential(
+            nn.Upsample(scale_factor=2, mode='nearest'),
+            nn.Conv1d(dim, dim, 3, padding=1, groups=dim, bias=False),
+            nn.Conv1d(dim, default(dim_out, dim), 1)
+        )
     return nn.Sequential(
         nn.Upsample(scale_factor=2, mode='nearest'),
         nn.Conv1d(dim, default(dim_out, dim), 3, padding=1)
@@ -32,7 +40,8 @@ class RMSNorm(nn.Module):
         self.g = nn.Parameter(torch.ones(1, dim, 1))
 
     def forward(self, x):
-        return F.normalize(x, dim=1) * self.g * (x.shape[1] ** 0.5)
+        # x / rms(x), equal to normalize(x) * sqrt(C) up to eps, in one reduction and one multiply
+        return x * torch.rsqrt(x.pow(2).mean(dim=1, keepdim=True) + 1e-6) * self.g
 
 class PreNorm(nn.Module):
     def __init__(self, dim, fn):
@@ -52,12 +61,13 @@ class SinusoidalPosEmb(nn.Module):
         self.dim = dim
         self.theta = theta
 
+        half_dim = dim // 2
+        emb = math.log(theta) / (half_dim - 1)
+        self.register_buffer('freqs', torch.exp(torch.arange(half_dim) * -emb), persistent=False)
+
     def forward(self, x):
-        device = x.device
-        half_dim = self.dim // 2
-        emb = math.log(self.theta) / (half_dim - 1)
-        emb = torch.exp(torch.arange(half_dim, device=device) * -emb)
-        emb = x[:, None] * emb[None, :]
+        # kept in float32, the phases of large timesteps lose too much precision in half types
+        emb = x[:, None].float() * self.freqs[None, :]
         emb = torch.cat((emb.sin(), emb.cos()), dim=-1)
         return emb
 
@@ -72,64 +82,149 @@ class RandomOrLearnedSinusoidalPosEmb(nn.Module):
         self.weights = nn.Parameter(torch.randn(half_dim), requires_grad=not is_random)
 
     def forward(self, x):
-        x = rearrange(x, 'b -> b 1')
-        freqs = x * rearrange(self.weights, 'd -> 1 d') * 2 * math.pi
-        fouriered = torch.cat((freqs.sin(), freqs.cos()), dim=-1)
-        fouriered = torch.cat((x, fouriered), dim=-1)
+        half_dim = self.weights.shape[0]
+        freqs = x[:, None] * self.weights[None, :] * (2 * math.pi)
+
+        if torch.is_grad_enabled() and self.weights.requires_grad:
+            # out= is not differentiable, so learned weights take a single concatenation
+            return torch.cat((x[:, None].to(freqs.dtype), freqs.sin(), freqs.cos()), dim=-1)
+
+        # [x, sin, cos] written straight into one preallocated output
+        fouriered = freqs.new_empty(x.shape[0], 1 + 2 * half_dim)
+        fouriered[:, 0] = x
+        torch.sin(freqs, out=fouriered[:, 1:half_dim + 1])
+        torch.cos(freqs, out=fouriered[:, half_dim + 1:])
         return fouriered
 
 # building block modules
 
+def script_helper_modules(module):
+    # swap the small leaf modules for their TorchScript versions in place; state dict keys are unchanged.
+    # Residual and the attention blocks are left eager, they wrap arbitrary callables / use lambdas
+    for name, child in module.named_children():
+        if isinstance(child, (Block, RMSNorm, SinusoidalPosEmb)):
+            setattr(module, name, torch.jit.script(child))
+        else:
+            script_helper_modules(child)
+    return module
+
+def group_norm(x, groups: int, eps: float):
+    """
+    group_norm without its affine. The statistics are taken in float32 but applied in x's dtype, where
+    F.group_norm under autocast would round trip the whole activation through float32
+    """
+    xg = x.reshape(x.shape[0], groups, -1)
+    var, mean = torch.var_mean(xg.float(), dim=-1, unbiased=False, keepdim=True)
+    return ((xg - mean.to(x.dtype)) * torch.rsqrt(var + eps).to(x.dtype)).reshape_as(x)
+
+def group_norm_scale_shift_silu(x, groups: int, weight, bias, eps: float, scale, shift):
+    """
+    silu(group_norm(x) * (scale + 1) + shift). The norm's affine is folded together with the modulation
+    into per-channel (b, c, 1) coefficients, so the activation sees one addcmul after the norm
+    """
+    x = group_norm(x, groups, eps)
+
+    # (x * weight + bias) * (scale + 1) + shift  ==  x * (weight * (scale + 1)) + (bias * (scale + 1) + shift)
+    scale = (scale + 1).to(x.dtype)
+    weight, bias = weight.to(x.dtype), bias.to(x.dtype)
+    return F.silu(torch.addcmul(torch.addcmul(shift.to(x.dtype), bias[:, None], scale), x, weight[:, None] * scale))
+
+def conv1d_over_cat(x, skip, weight, bias: Optional[torch.Tensor], padding: int):
+    # conv(cat((x, skip), dim=1)) from the two channel slices of the weight, so the concatenation is never materialised
+    c = x.shape[1]
+    out = F.conv1d(x, weight[:, :c], bias, padding=padding)
+    return out + F.conv1d(skip, weight[:, c:], None, padding=padding)
+
 class Block(nn.Module):
-    def __init__(self, dim, dim_out, groups=8):
+    # a constant under TorchScript; a plain int that torch.compile specialises on
+    groups: Final[int]
+
+    def __init__(self, dim, dim_out, groups=8, separable=False):
         super().__init__()
-        self.proj = nn.Conv1d(dim, dim_out, 3, padding=1)
-        self.norm = nn.GroupNorm(groups, dim_out)
+        assert dim_out % groups == 0, f'block output channels ({dim_out}) must be divisible by resnet_block_groups ({groups})'
+        self.groups = int(groups)
+        # separable: a depthwise 3-tap conv then a pointwise 1x1 proj, in place of the dense 3-tap proj
+        self.depthwise = nn.Conv1d(dim, dim, 3, padding=1, groups=dim, bias=False) if separable else None
+        self.proj = nn.Conv1d(dim, dim_out, 1) if separable else nn.Conv1d(dim, dim_out, 3, padding=1)
+        self.proj_padding = 0 if separable else 1
+        self.norm = nn.GroupNorm(self.groups, dim_out)
         self.act = nn.SiLU()
 
-    def forward(self, x, scale_shift=None):
-        x = self.proj(x)
-        x = self.norm(x)
+    def forward(self, x, scale_shift: Optional[Tuple[torch.Tensor, torch.Tensor]] = None, skip: Optional[torch.Tensor] = None):
+        if self.depthwise is not None:
+            if skip is None:
+                x = self.depthwise(x)
+            else:
+                # depthwise is per channel, so x and skip each take their own slice of the filters
+                c = x.shape[1]
+                x, skip = (F.conv1d(x, self.depthwise.weight[:c], None, padding=1, groups=c),
+                           F.conv1d(skip, self.depthwise.weight[c:], None, padding=1, groups=skip.shape[1]))
+
+        x = self.proj(x) if skip is None else conv1d_over_cat(x, skip, self.proj.weight, self.proj.bias, self.proj_padding)
 
-        if exists(scale_shift):
+        if scale_shift is not None:
             scale, shift = scale_shift
-            x = x * (scale + 1) + shift
+            return group_norm_scale_shift_silu(x, self.groups, self.norm.weight, self.norm.bias, self.norm.eps, scale, shift)
 
+        # self.norm only holds the affine parameters and eps, see group_norm
+        x = torch.addcmul(self.norm.bias.to(x.dtype)[:, None], group_norm(x, self.groups, self.norm.eps), self.norm.weight.to(x.dtype)[:, None])
         x = self.act(x)
         return x
 
 class ResnetBlock(nn.Module):
-    def __init__(self, dim, dim_out, *, time_emb_dim=None, cond_emb_dim=None, groups=8):
+    def __init__(self, dim, dim_out, *, time_emb_dim=None, cond_emb_dim=None, groups=8, compile_block=False, separable=False):
         super().__init__()
         self.mlp = nn.Sequential(
             nn.SiLU(),
             nn.Linear(time_emb_dim + int(cond_emb_dim), dim_out * 2)
         ) if exists(time_emb_dim) or exists(cond_emb_dim) else None
+        self.time_emb_dim = time_emb_dim
 
-        self.block1 = Block(dim, dim_out, groups=groups)
-        self.block2 = Block(dim_out, dim_out, groups=groups)
+        self.block1 = Block(dim, dim_out, groups=groups, separable=separable)
+        self.block2 = Block(dim_out, dim_out, groups=groups, separable=separable)
         self.res_conv = nn.Conv1d(dim, dim_out, 1) if dim != dim_out else nn.Identity()
 
-    def forward(self, x, time_emb=None, cond_emb=None):
+        self.compile_block = compile_block
+
+    def precompute_cond(self, cond_emb):
+        # silu(cat(t, c)) == cat(silu(t), silu(c)), so the mlp splits by weight columns into a time and a cond part.
+        # the cond part (with the bias) is fixed over a sampling loop and computed once here
+        if not exists(self.mlp):
+            return None
+        linear = self.mlp[1]
+        return F.linear(F.silu(cond_emb), linear.weight[:, self.time_emb_dim:], linear.bias)
+
+    def forward(self, *args, **kwargs):
+        if self.compile_block:
+            # one compiled wrapper for the class's _forward, but dynamo specialises it on each block's parameter
+            # shapes, so every distinct block config is its own cache entry (the u-net raises the limit to fit)
+            return compiled(type(self)._forward, dynamic=True)(self, *args, **kwargs)
+        return self._forward(*args, **kwargs)
+
+    def _forward(self, x, time_emb=None, cond_emb=None, cond_proj=None, skip=None):
 
         scale_shift = None
-        if exists(self.mlp) and exists(time_emb) or exists(cond_emb):
-            cond_emb = tuple(filter(exists, (time_emb, cond_emb)))
-            cond_emb = torch.cat(cond_emb, dim = -1)
-            cond_emb = self.mlp(cond_emb.float())
-            cond_emb = rearrange(cond_emb, 'b c -> b c 1')
+        if exists(self.mlp):
+            if exists(cond_proj):
+                cond_emb = cond_proj + F.linear(F.silu(time_emb), self.mlp[1].weight[:, :self.time_emb_dim])
+            else:
+                # the mlp expects both embeddings, concatenated in this order
+                cond_emb = torch.cat((time_emb, cond_emb), dim = -1)
+                cond_emb = self.mlp(cond_emb)
+            cond_emb = cond_emb.unsqueeze(-1)
             scale_shift = cond_emb.chunk(2, dim = 1)
 
-        h = self.block1(x, scale_shift = scale_shift)
+        # skip: the u-net skip connection, treated as if concatenated after x along the channels
+        h = self.block1(x, scale_shift = scale_shift, skip = skip)
 
         h = self.block2(h)
 
-        return h + self.res_conv(x)
+        return h + (self.res_conv(x) if not exists(skip) else conv1d_over_cat(x, skip, self.res_conv.weight, self.res_conv.bias, 0))
 
 class FullyConditionedResnet(nn.Module):
     def __init__(self, dim, dim_out, *, 
                  time_emb_dim=None, cond_emb_dim=None, 
-                 inits_emb_dim=None, groups=8):
+                 inits_emb_dim=None, groups=8, compile_block=False, separable=False):
         super().__init__()
         concat_dim = (time_emb_dim if time_emb_dim else 0) + (cond_emb_dim if cond_emb_dim else 0) + (inits_emb_dim if inits_emb_dim else 0)
         self.mlp = nn.Sequential(
@@ -137,33 +232,87 @@ class FullyConditionedResnet(nn.Module):
             nn.Linear(concat_dim, dim_out * 2)
         ) if concat_dim > 0 else None
 
-        self.block1 = Block(dim, dim_out, groups=groups)
-        self.block2 = Block(dim_out, dim_out, groups=groups)
+        # which of (time, cond, inits) feed the mlp is fixed by the dims, so forward concatenates a static selection
+        self.emb_indices = tuple(ind for ind, emb_dim in enumerate((time_emb_dim, cond_emb_dim, inits_emb_dim)) if emb_dim)
+
+        # column range of each used embedding in the mlp's weight, time first
+        emb_dims = (time_emb_dim, cond_emb_dim, inits_emb_dim)
+        ends = [sum(emb_dims[ind] for ind in self.emb_indices[:k + 1]) for k in range(len(self.emb_indices))]
+        self.emb_slices = tuple((ind, end - emb_dims[ind], end) for ind, end in zip(self.emb_indices, ends))
+        self.time_emb_dim = time_emb_dim or 0
+
+        self.block1 = Block(dim, dim_out, groups=groups, separable=separable)
+        self.block2 = Block(dim_out, dim_out, groups=groups, separable=separable)
         self.res_conv = nn.Conv1d(dim, dim_out, 1) if dim != dim_out else nn.Identity()
 
-    def forward(self, x, time_emb=None, cond_emb=None, inits_emb=None):
+        self.compile_block = compile_block
+
+    def precompute_cond(self, cond_emb=None, inits_emb=None):
+        # silu(cat(t, c, i)) == cat(silu(t), silu(c), silu(i)), so the mlp splits by weight columns per embedding.
+        # the cond and inits parts (with the bias) are fixed over a sampling loop and computed once here
+        if not exists(self.mlp):
+            return None
+        linear = self.mlp[1]
+        embs = (None, cond_emb, inits_emb)
+        out = linear.bias
+        for ind, start, end in self.emb_slices:
+            if ind > 0:
+                out = out + F.linear(F.silu(embs[ind]), linear.weight[:, start:end])
+        return out
+
+    def forward(self, *args, **kwargs):
+        if self.compile_block:
+            # one compiled wrapper for the class's _forward, but dynamo specialises it on each block's parameter
+            # shapes, so every distinct block config is its own cache entry (the u-net raises the limit to fit)
+            return compiled(type(self)._forward, dynamic=True)(self, *args, **kwargs)
+        return self._forward(*args, **kwargs)
+
+    def _forward(self, x, time_emb=None, cond_emb=None, inits_emb=None, cond_proj=None, skip=None):
 
         scale_shift = None
-        if exists(self.mlp) and (exists(time_emb) or exists(cond_emb) or exists(inits_emb)):
-            cond_emb = tuple(filter(exists, (time_emb, cond_emb, inits_emb)))
-            cond_emb = torch.cat(cond_emb, dim = -1)
-            cond_emb = self.mlp(cond_emb.float())
-            cond_emb = rearrange(cond_emb, 'b c -> b c 1')
+        if exists(self.mlp):
+            if exists(cond_proj):
+                cond_emb = cond_proj
+                if self.time_emb_dim:
+                    cond_emb = cond_emb + F.linear(F.silu(time_emb), self.mlp[1].weight[:, :self.time_emb_dim])
+            else:
+                embs = (time_emb, cond_emb, inits_emb)
+                cond_emb = torch.cat([embs[ind] for ind in self.emb_indices], dim = -1)
+                cond_emb = self.mlp(cond_emb)
+            cond_emb = cond_emb.unsqueeze(-1)
             scale_shift = cond_emb.chunk(2, dim = 1)
 
-        h = self.block1(x, scale_shift = scale_shift)
+        # skip: the u-net skip connection, treated as if concatenated after x along the channels
+        h = self.block1(x, scale_shift = scale_shift, skip = skip)
 
         h = self.block2(h)
 
-        return h + self.res_conv(x)
+        return h + (self.res_conv(x) if not exists(skip) else conv1d_over_cat(x, skip, self.res_conv.weight, self.res_conv.bias, 0))
+
+def qkv_projection(dim, hidden_dim, heads, grouped=False):
+    # grouped: each head projects its own dim // heads slice of the input, 1 / heads of the weights and flops.
+    # a group's output channels are that head's (q, k, v), so the layout is (h qkv c) rather than (qkv h c)
+    if not grouped:
+        return nn.Conv1d(dim, hidden_dim * 3, 1, bias=False)
+    assert dim % heads == 0, f'grouped qkv needs dim ({dim}) divisible by heads ({heads})'
+    return nn.Conv1d(dim, hidden_dim * 3, 1, bias=False, groups=heads)
+
+def split_qkv(qkv, heads, dim_head, grouped=False):
+    # (b, 3 * h * d, n) -> q, k, v each (b, h, d, n), for the (h qkv d) channel layout of the grouped projection or (qkv h d)
+    b, _, n = qkv.shape
+    if grouped:
+        return qkv.view(b, heads, 3, dim_head, n).unbind(2)
+    return qkv.view(b, 3, heads, dim_head, n).unbind(1)
 
 class LinearAttention(nn.Module):
-    def __init__(self, dim, heads=4, dim_head=32):
+    def __init__(self, dim, heads=4, dim_head=32, grouped_qkv=False):
         super().__init__()
         self.scale = dim_head ** -0.5
         self.heads = heads
         hidden_dim = dim_head * heads
-        self.to_qkv = nn.Conv1d(dim, hidden_dim * 3, 1, bias=False)
+        self.to_qkv = qkv_projection(dim, hidden_dim, heads, grouped_qkv)
+        self.dim_head = dim_head
+        self.grouped_qkv = grouped_qkv
 
         self.to_out = nn.Sequential(
             nn.Conv1d(hidden_dim, dim, 1),
@@ -172,42 +321,42 @@ class LinearAttention(nn.Module):
 
     def forward(self, x):
         b, c, n = x.shape
-        qkv = self.to_qkv(x).chunk(3, dim = 1)
-        q, k, v = map(lambda t: rearrange(t, 'b (h c) n -> b h c n', h=self.heads), qkv)
+        qkv = split_qkv(self.to_qkv(x), self.heads, self.dim_head, self.grouped_qkv)
+        # heads folded into the batch so both contractions are plain batched matmuls
+        q, k, v = map(lambda t: t.reshape(b * self.heads, self.dim_head, n), qkv)
 
         q = q.softmax(dim = -2)
         k = k.softmax(dim = -1)
 
         q = q * self.scale        
 
-        context = torch.einsum('b h d n, b h e n -> b h d e', k, v)
+        context = torch.bmm(k, v.transpose(1, 2))
 
-        out = torch.einsum('b h d e, b h d n -> b h e n', context, q)
-        out = rearrange(out, 'b h c n -> b (h c) n', h=self.heads)
+        out = torch.bmm(context.transpose(1, 2), q)
+        out = out.reshape(b, -1, n)
         return self.to_out(out)
 
 class Attention(nn.Module):
-    def __init__(self, dim, heads=4, dim_head=32):
+    def __init__(self, dim, heads=4, dim_head=32, grouped_qkv=False):
         super().__init__()
-        self.scale = dim_head ** -0.5
         self.heads = heads
         hidden_dim = dim_head * heads
 
-        self.to_qkv = nn.Conv1d(dim, hidden_dim * 3, 1, bias=False)
+        self.to_qkv = qkv_projection(dim, hidden_dim, heads, grouped_qkv)
+        self.dim_head = dim_head
+        self.grouped_qkv = grouped_qkv
         self.to_out = nn.Conv1d(hidden_dim, dim, 1)
 
     def forward(self, x):
         b, c, n = x.shape
-        qkv = self.to_qkv(x).chunk(3, dim=1)
-        q, k, v = map(lambda t: rearrange(t, 'b (h c) n -> b h c n', h=self.heads), qkv)
-
-        q = q * self.scale
+        # (b, h, n, d) with d innermost: the flash / memory efficient kernels need a unit stride on the last dim,
+        # a transposed view would fall back to the math kernel and its full n x n attention matrix
+        q, k, v = map(lambda t: t.transpose(-1, -2).contiguous(), split_qkv(self.to_qkv(x), self.heads, self.dim_head, self.grouped_qkv))
 
-        sim = einsum('b h d i, b h d j -> b h i j', q, k)
-        attn = sim.softmax(dim = -1)
-        out = einsum('b h i j, b h d j -> b h i d', attn, v)
+        # scales by dim_head ** -0.5 internally
+        out = F.scaled_dot_product_attention(q, k, v)
 
-        out = rearrange(out, 'b h n d -> b (h d) n')
+        out = out.transpose(2, 3).reshape(b, self.heads * self.dim_head, n)
         return self.to_out(out)
 
 
@@ -228,12 +377,27 @@ class Unet(nn.Module):
         learned_sinusoidal_dim=16,
         sinusoidal_pos_emb_theta=10000,
         attn_dim_head=32,
-        attn_heads=4
+        attn_heads=4,
+        # grouped per-head qkv projections, changes the parameter shapes so older checkpoints will not load
+        attn_grouped_qkv=False,
+        # compile the whole forward with torch.compile for fixed input shapes
+        compile_forward=False,
+        compile_mode='reduce-overhead',
+        # compile each resnet block separately (regional compilation), cheaper to compile than the full forward
+        compile_blocks=False,
+        # run the network under torch.autocast in this dtype, e.g. torch.bfloat16
+        autocast_dtype=None,
+        # torch.jit.script the small helper modules (Block, RMSNorm, SinusoidalPosEmb), an alternative to torch.compile
+        script_modules=False,
+        # depthwise separable 3-tap convs in the resnet blocks and upsamples, changes the architecture
+        separable_convs=False
     ):
         super().__init__()
         # classifier free guidance stuff
         self.cond_drop_prob = cond_drop_prob
         self.cond_dim = cond_dim
+        self.autocast_dtype = autocast_dtype
+        self._graph = None
 
         # determine dimensions
         self.channels = channels
@@ -245,7 +409,7 @@ class Unet(nn.Module):
         dims = [init_dim, *map(lambda m: dim * m, dim_mults)]
         in_out = list(zip(dims[:-1], dims[1:]))
 
-        block_klass = partial(ResnetBlock, groups=resnet_block_groups)
+        block_klass = partial(ResnetBlock, groups=resnet_block_groups, compile_block=compile_blocks, separable=separable_convs)
 
         # time embeddings
         time_dim = dim * 4
@@ -280,13 +444,13 @@ class Unet(nn.Module):
             self.downs.append(nn.ModuleList([
                 block_klass(dim_in, dim_in, time_emb_dim=time_dim, cond_emb_dim=cond_dim),
                 block_klass(dim_in, dim_in, time_emb_dim=time_dim, cond_emb_dim=cond_dim),
-                Residual(PreNorm(dim_in, LinearAttention(dim_in))),
+                Residual(PreNorm(dim_in, LinearAttention(dim_in, grouped_qkv=attn_grouped_qkv))),
                 Downsample(dim_in, dim_out) if not is_last else nn.Conv1d(dim_in, dim_out, 3, padding=1)
             ]))
 
         mid_dim = dims[-1]
         self.mid_block1 = block_klass(mid_dim, mid_dim, time_emb_dim=time_dim, cond_emb_dim=cond_dim)
-        self.mid_attn = Residual(PreNorm(mid_dim, Attention(mid_dim, dim_head=attn_dim_head, heads=attn_heads)))
+        self.mid_attn = Residual(PreNorm(mid_dim, Attention(mid_dim, dim_head=attn_dim_head, heads=attn_heads, grouped_qkv=attn_grouped_qkv)))
         self.mid_block2 = block_klass(mid_dim, mid_dim, time_emb_dim=time_dim, cond_emb_dim=cond_dim)
 
         for ind, (dim_in, dim_out) in enumerate(reversed(in_out)):
@@ -295,8 +459,8 @@ class Unet(nn.Module):
             self.ups.append(nn.ModuleList([
                 block_klass(dim_out + dim_in, dim_out, time_emb_dim = time_dim, cond_emb_dim = cond_dim),
                 block_klass(dim_out + dim_in, dim_out, time_emb_dim = time_dim, cond_emb_dim = cond_dim),
-                Residual(PreNorm(dim_out, LinearAttention(dim_out))),
-                Upsample(dim_out, dim_in) if not is_last else  nn.Conv1d(dim_out, dim_in, 3, padding=1)
+                Residual(PreNorm(dim_out, LinearAttention(dim_out, grouped_qkv=attn_grouped_qkv))),
+                Upsample(dim_out, dim_in, separable=separable_convs) if not is_last else  nn.Conv1d(dim_out, dim_in, 3, padding=1)
             ]))
 
         default_out_dim = channels * (1 if not learned_variance else 2)
@@ -305,6 +469,36 @@ class Unet(nn.Module):
         self.final_res_block = block_klass(dim * 2, dim, time_emb_dim=time_dim, cond_emb_dim=cond_dim)
         self.final_conv = nn.Conv1d(dim, self.out_dim, 1)
 
+        self.num_resnet_blocks = len(self.resnet_blocks())
+
+        if compile_blocks:
+            # room for every block config x grad mode x with / without cond_proj of the shared compiled _forward
+            raise_compile_cache_limit(4 * self.num_resnet_blocks)
+
+        self.script_modules = script_modules
+        if script_modules:
+            assert not (compile_forward or compile_blocks), 'script_modules and torch.compile are alternatives, enable at most one'
+            script_helper_modules(self)
+
+        self.compile_kwargs = None
+        if compile_forward:
+            self.enable_compile(compile_mode)
+
+
+    def resnet_blocks(self):
+        # every resnet block, in the order _forward calls them
+        blocks = [block for block1, block2, *_ in self.downs for block in (block1, block2)]
+        blocks += [self.mid_block1, self.mid_block2]
+        blocks += [block for block1, block2, *_ in self.ups for block in (block1, block2)]
+        return blocks + [self.final_res_block]
+
+    def precompute_cond(self, cond):
+        """
+        Per-block conditioning projections for a sampling loop where cond stays fixed,
+        passed back as cond_proj so each step only projects the time embedding
+        """
+        c = cond.float()
+        return tuple(block.precompute_cond(c) for block in self.resnet_blocks())
 
     def forward_with_cond_scale(
         self,
@@ -313,12 +507,15 @@ class Unet(nn.Module):
         rescaled_phi=0.,
         **kwargs
     ):
-        logits = self.forward(*args, cond_drop_prob=0., **kwargs)
+        logits = self.forward_cond(*args, **kwargs)
 
         if cond_scale == 1:
             return logits
 
-        null_logits = self.forward(*args, cond_drop_prob=1., **kwargs)
+        # under mode='reduce-overhead' the compiled graph's output buffer is reused by the next call
+        logits = logits.clone()
+
+        null_logits = self.forward_null(*args, **kwargs)
         scaled_logits = null_logits + (logits - null_logits) * cond_scale
 
         if rescaled_phi == 0.:
@@ -329,7 +526,7 @@ class Unet(nn.Module):
 
         return rescaled_logits * rescaled_phi + scaled_logits * (1. - rescaled_phi)
 
-    def forward(self, x, time, cond, cond_drop_prob=None):
+    def forward(self, x, time, cond, cond_drop_prob=None, cond_proj=None):
         # if self.self_condition:
         #     x_self_cond = default(x_self_cond, lambda: torch.zeros_like(x))
 
@@ -339,54 +536,109 @@ class Unet(nn.Module):
         cond_drop_prob = default(cond_drop_prob, self.cond_drop_prob)
 
         if cond_drop_prob > 0:
-            keep_mask = prob_mask_like((batch,), 1 - cond_drop_prob, device=device)
-            null_classes_emb = repeat(self.null_classes_emb, 'd -> b d', b=batch)
-
-            cond = torch.where(
-                rearrange(keep_mask, 'b -> b 1'),
-                cond,
-                null_classes_emb
-            )
-
-        c = cond
-
-
-        # unet
-        x = self.init_conv(x.float())
-        r = x.clone()
-
-        t = self.time_mlp(time)
-
-
-        h = []
-        for block1, block2, attn, downsample in self.downs:
-            x = block1(x.float(), t, c)
-            h.append(x)
-
-            x = block2(x.float(), t, c)
-            x = attn(x)
-            h.append(x)
-
-            x = downsample(x)
-
-        x = self.mid_block1(x, t, c)
-        x = self.mid_attn(x)
-        x = self.mid_block2(x, t, c)
-
-        for block1, block2, attn, upsample in self.ups:
-            x = torch.cat((x, h.pop()), dim=1)
-            x = block1(x, t, c)
-
-            x = torch.cat((x, h.pop()), dim=1)
-            x = block2(x, t, c)
-            x = attn(x)
-
-            x = upsample(x)
-
-        x = torch.cat((x, r), dim=1)
-
-        x = self.final_res_block(x, t, c)
-        return self.final_conv(x)
+            # a (batch, 1) 0 / 1 weight against a (1, d) null embedding, one broadcast lerp picks cond or null per row
+            keep_mask = prob_mask_like((batch, 1), 1 - cond_drop_prob, device=device)
+            null_classes_emb = self.null_classes_emb.unsqueeze(0)
+
+            cond = torch.lerp(null_classes_emb, cond.to(null_classes_emb.dtype), keep_mask.to(null_classes_emb.dtype))
+            # projections of the undropped cond no longer apply
+            cond_proj = None
+
+        return self._run(x, time, cond, cond_proj)
+
+    def capture(self, sample_shape, cond_shape):
+        """
+        Captures the conditional forward for fixed input shapes into a CUDA graph. While gradients
+        are off, forward_cond copies inputs of these shapes into static buffers and replays it; any other
+        shape runs eagerly. With guided classifier-free guidance the sampler feeds the guided and unguided
+        passes as one doubled batch, so capture with a batch of 2 * b.
+        """
+        assert not torch.cuda.is_current_stream_capturing(), 'capture cannot run inside another CUDA graph capture'
+        device = next(self.parameters()).device
+        self._graph_x = torch.randn(sample_shape, device=device)
+        self._graph_t = torch.zeros(sample_shape[0], device=device, dtype=torch.long)
+        self._graph_cond = torch.zeros(cond_shape, device=device)
+        args = (self._graph_x, self._graph_t, self._graph_cond)
+
+        with torch.no_grad():
+            # warm up on a side stream so lazy initialisation is not recorded
+            stream = torch.cuda.Stream()
+            stream.wait_stream(torch.cuda.current_stream())
+            with torch.cuda.stream(stream):
+                for _ in range(3):
+                    self._forward(*args)
+            torch.cuda.current_stream().wait_stream(stream)
+
+            self._graph = torch.cuda.CUDAGraph()
+            with torch.cuda.graph(self._graph):
+                self._graph_out = self._forward(*args)
+
+    def forward_cond(self, x, time, cond, cond_proj=None):
+        # equivalent to forward with cond_drop_prob=0.
+        if exists(self._graph) and not torch.is_grad_enabled() and x.shape == self._graph_x.shape and cond.shape == self._graph_cond.shape:
+            self._graph_x.copy_(x)
+            self._graph_t.copy_(time)
+            self._graph_cond.copy_(cond)
+            self._graph.replay()
+            # the output buffer is overwritten by the next replay
+            return self._graph_out.clone()
+        return self._run(x, time, cond, cond_proj)
+
+    def forward_null(self, x, time, cond, cond_proj=None):
+        # equivalent to forward with cond_drop_prob=1., every row gets the null embedding (cond_proj is for the real cond and is ignored)
+        return self._run(x, time, self.null_classes_emb.expand(x.shape[0], -1))
+
+    def enable_compile(self, mode='reduce-overhead', fullgraph=True):
+        # only the network is compiled, conditioning dropout runs eagerly in forward. fixed input shapes,
+        # a batch size that changes (sampling vs training, the doubled guided batch) compiles another graph
+        assert not self.script_modules, 'script_modules and torch.compile are alternatives, enable at most one'
+        self.compile_kwargs = dict(mode=mode, fullgraph=fullgraph, dynamic=False)
+
+    def _run(self, *args):
+        if exists(self.compile_kwargs):
+            return compiled(type(self)._forward, **self.compile_kwargs)(self, *args)
+        return self._forward(*args)
+
+    def _forward(self, x, time, cond, cond_proj=None):
+        # inputs are cast once here so nothing below changes dtype mid-graph
+        c = cond.float()
+        proj = iter(default(cond_proj, (None,) * self.num_resnet_blocks))
+
+        # unet, in autocast_dtype when set; the output is returned in float32
+        # nullcontext rather than enabled=False, which would switch off an enclosing autocast (the sampler's sample_dtype)
+        with torch.autocast(device_type=x.device.type, dtype=self.autocast_dtype) if exists(self.autocast_dtype) else nullcontext():
+            x = self.init_conv(x.float())
+            r = x
+
+            t = self.time_mlp(time)
+
+
+            # skip connections in a fixed-size list written and read by index
+            h = [None] * (2 * len(self.downs))
+            for ind, (block1, block2, attn, downsample) in enumerate(self.downs):
+                x = block1(x, t, c, cond_proj=next(proj))
+                h[2 * ind] = x
+
+                x = block2(x, t, c, cond_proj=next(proj))
+                x = attn(x)
+                h[2 * ind + 1] = x
+
+                x = downsample(x)
+
+            x = self.mid_block1(x, t, c, cond_proj=next(proj))
+            x = self.mid_attn(x)
+            x = self.mid_block2(x, t, c, cond_proj=next(proj))
+
+            for ind, (block1, block2, attn, upsample) in enumerate(self.ups):
+                x = block1(x, t, c, cond_proj=next(proj), skip=h[-2 * ind - 1])
+
+                x = block2(x, t, c, cond_proj=next(proj), skip=h[-2 * ind - 2])
+                x = attn(x)
+
+                x = upsample(x)
+
+            x = self.final_res_block(x, t, c, cond_proj=next(proj), skip=r)
+            return self.final_conv(x).float()
 
 class FullyConditionedUnet(nn.Module):
     def __init__(
@@ -405,12 +657,27 @@ class FullyConditionedUnet(nn.Module):
         learned_sinusoidal_dim=16,
         sinusoidal_pos_emb_theta=10000,
         attn_dim_head=32,
-        attn_heads=4
+        attn_heads=4,
+        # grouped per-head qkv projections, changes the parameter shapes so older checkpoints will not load
+        attn_grouped_qkv=False,
+        # compile the whole forward with torch.compile for fixed input shapes
+        compile_forward=False,
+        compile_mode='reduce-overhead',
+        # compile each resnet block separately (regional compilation), cheaper to compile than the full forward
+        compile_blocks=False,
+        # run the network under torch.autocast in this dtype, e.g. torch.bfloat16
+        autocast_dtype=None,
+        # torch.jit.script the small helper modules (Block, RMSNorm, SinusoidalPosEmb), an alternative to torch.compile
+        script_modules=False,
+        # depthwise separable 3-tap convs in the resnet blocks and upsamples, changes the architecture
+        separable_convs=False
     ):
         super().__init__()
         # classifier free guidance stuff
         self.cond_drop_prob = cond_drop_prob
         self.cond_dim = cond_dim
+        self.autocast_dtype = autocast_dtype
+        self._graph = None
 
         # determine dimensions
         self.channels = channels
@@ -422,7 +689,7 @@ class FullyConditionedUnet(nn.Module):
         dims = [init_dim, *map(lambda m: dim * m, dim_mults)]
         in_out = list(zip(dims[:-1], dims[1:]))
 
-        block_klass = partial(FullyConditionedResnet, groups=resnet_block_groups)
+        block_klass = partial(FullyConditionedResnet, groups=resnet_block_groups, compile_block=compile_blocks, separable=separable_convs)
 
         # time embeddings
         time_dim = dim * 4
@@ -467,13 +734,13 @@ class FullyConditionedUnet(nn.Module):
             self.downs.append(nn.ModuleList([
                 block_klass(dim_in, dim_in, time_emb_dim=time_dim, cond_emb_dim=cond_dim, inits_emb_dim=inits_emb_dim),
                 block_klass(dim_in, dim_in, time_emb_dim=time_dim, cond_emb_dim=cond_dim, inits_emb_dim=inits_emb_dim),
-                Residual(PreNorm(dim_in, LinearAttention(dim_in))),
+                Residual(PreNorm(dim_in, LinearAttention(dim_in, grouped_qkv=attn_grouped_qkv))),
                 Downsample(dim_in, dim_out) if not is_last else nn.Conv1d(dim_in, dim_out, 3, padding=1)
             ]))
 
         mid_dim = dims[-1]
         self.mid_block1 = block_klass(mid_dim, mid_dim, time_emb_dim=time_dim, cond_emb_dim=cond_dim, inits_emb_dim=inits_emb_dim)
-        self.mid_attn = Residual(PreNorm(mid_dim, Attention(mid_dim, dim_head=attn_dim_head, heads=attn_heads)))
+        self.mid_attn = Residual(PreNorm(mid_dim, Attention(mid_dim, dim_head=attn_dim_head, heads=attn_heads, grouped_qkv=attn_grouped_qkv)))
         self.mid_block2 = block_klass(mid_dim, mid_dim, time_emb_dim=time_dim, cond_emb_dim=cond_dim, inits_emb_dim=inits_emb_dim)
 
         for ind, (dim_in, dim_out) in enumerate(reversed(in_out)):
@@ -482,8 +749,8 @@ class FullyConditionedUnet(nn.Module):
             self.ups.append(nn.ModuleList([
                 block_klass(dim_out + dim_in, dim_out, time_emb_dim = time_dim, cond_emb_dim = cond_dim, inits_emb_dim=inits_emb_dim),
                 block_klass(dim_out + dim_in, dim_out, time_emb_dim = time_dim, cond_emb_dim = cond_dim, inits_emb_dim=inits_emb_dim),
-                Residual(PreNorm(dim_out, LinearAttention(dim_out))),
-                Upsample(dim_out, dim_in) if not is_last else  nn.Conv1d(dim_out, dim_in, 3, padding=1)
+                Residual(PreNorm(dim_out, LinearAttention(dim_out, grouped_qkv=attn_grouped_qkv))),
+                Upsample(dim_out, dim_in, separable=separable_convs) if not is_last else  nn.Conv1d(dim_out, dim_in, 3, padding=1)
             ]))
 
         default_out_dim = channels * (1 if not learned_variance else 2)
@@ -492,6 +759,36 @@ class FullyConditionedUnet(nn.Module):
         self.final_res_block = block_klass(dim * 2, dim, time_emb_dim=time_dim, cond_emb_dim=cond_dim, inits_emb_dim=inits_emb_dim)
         self.final_conv = nn.Conv1d(dim, self.out_dim, 1)
 
+        self.num_resnet_blocks = len(self.resnet_blocks())
+
+        if compile_blocks:
+            # room for every block config x grad mode x with / without cond_proj of the shared compiled _forward
+            raise_compile_cache_limit(4 * self.num_resnet_blocks)
+
+        self.script_modules = script_modules
+        if script_modules:
+            assert not (compile_forward or compile_blocks), 'script_modules and torch.compile are alternatives, enable at most one'
+            script_helper_modules(self)
+
+        self.compile_kwargs = None
+        if compile_forward:
+            self.enable_compile(compile_mode)
+
+
+    def resnet_blocks(self):
+        # every resnet block, in the order _forward calls them
+        blocks = [block for block1, block2, *_ in self.downs for block in (block1, block2)]
+        blocks += [self.mid_block1, self.mid_block2]
+        blocks += [block for block1, block2, *_ in self.ups for block in (block1, block2)]
+        return blocks + [self.final_res_block]
+
+    def precompute_cond(self, cond, inits):
+        """
+        Per-block conditioning projections for a sampling loop where cond and inits stay fixed,
+        passed back as cond_proj so each step only projects the time embedding
+        """
+        c, i = cond.float(), inits.float()
+        return tuple(block.precompute_cond(c, i) for block in self.resnet_blocks())
 
     def forward_with_cond_scale(
         self,
@@ -500,12 +797,15 @@ class FullyConditionedUnet(nn.Module):
         rescaled_phi=0.,
         **kwargs
     ):
-        logits = self.forward(*args, cond_drop_prob=0., **kwargs)
+        logits = self.forward_cond(*args, **kwargs)
 
         if cond_scale == 1:
             return logits
 
-        null_logits = self.forward(*args, cond_drop_prob=1., **kwargs)
+        # under mode='reduce-overhead' the compiled graph's output buffer is reused by the next call
+        logits = logits.clone()
+
+        null_logits = self.forward_null(*args, **kwargs)
         scaled_logits = null_logits + (logits - null_logits) * cond_scale
 
         if rescaled_phi == 0.:
@@ -516,7 +816,7 @@ class FullyConditionedUnet(nn.Module):
 
         return rescaled_logits * rescaled_phi + scaled_logits * (1. - rescaled_phi)
 
-    def forward(self, x, time, cond, inits, cond_drop_prob=None):
+    def forward(self, x, time, cond, inits, cond_drop_prob=None, cond_proj=None):
         # if self.self_condition:
         #     x_self_cond = default(x_self_cond, lambda: torch.zeros_like(x))
         
@@ -527,51 +827,110 @@ class FullyConditionedUnet(nn.Module):
         cond_drop_prob = default(cond_drop_prob, self.cond_drop_prob)
 
         if cond_drop_prob > 0:
-            keep_mask = prob_mask_like((batch,), 1 - cond_drop_prob, device=device)
-            null_classes_emb = repeat(self.null_classes_emb, 'd -> b d', b=batch)
-
-            cond = torch.where(
-                rearrange(keep_mask, 'b -> b 1'),
-                cond,
-                null_classes_emb
-            )
-
-        c = cond
-
-        # unet
-        x = self.init_conv(x.float())
-        r = x.clone()
-
-        t = self.time_mlp(time)
-        # i = self.inits_mlp(inits)
-        i = inits
-
-        h = []
-        for block1, block2, attn, downsample in self.downs:
-            x = block1(x.float(), t, c, i)
-            h.append(x)
-
-            x = block2(x.float(), t, c, i)
-            x = attn(x)
-            h.append(x)
-
-            x = downsample(x)
-
-        x = self.mid_block1(x, t, c, i)
-        x = self.mid_attn(x)
-        x = self.mid_block2(x, t, c, i)
-
-        for block1, block2, attn, upsample in self.ups:
-            x = torch.cat((x, h.pop()), dim=1)
-            x = block1(x, t, c, i)
-
-            x = torch.cat((x, h.pop()), dim=1)
-            x = block2(x, t, c, i)
-            x = attn(x)
-
-            x = upsample(x)
-
-        x = torch.cat((x, r), dim=1)
-
-        x = self.final_res_block(x, t, c, i)
-        return self.final_conv(x)
\ No newline at end of file
+            # a (batch, 1) 0 / 1 weight against a (1, d) null embedding, one broadcast lerp picks cond or null per row
+            keep_mask = prob_mask_like((batch, 1), 1 - cond_drop_prob, device=device)
+            null_classes_emb = self.null_classes_emb.unsqueeze(0)
+
+            cond = torch.lerp(null_classes_emb, cond.to(null_classes_emb.dtype), keep_mask.to(null_classes_emb.dtype))
+            # projections of the undropped cond no longer apply
+            cond_proj = None
+
+        return self._run(x, time, cond, inits, cond_proj)
+
+    def capture(self, sample_shape, cond_shape, inits_shape):
+        """
+        Captures the conditional forward for fixed input shapes into a CUDA graph. While gradients
+        are off, forward_cond copies inputs of these shapes into static buffers and replays it; any other
+        shape runs eagerly. With guided classifier-free guidance the sampler feeds the guided and unguided
+        passes as one doubled batch, so capture with a batch of 2 * b.
+        """
+        assert not torch.cuda.is_current_stream_capturing(), 'capture cannot run inside another CUDA graph capture'
+        device = next(self.parameters()).device
+        self._graph_x = torch.randn(sample_shape, device=device)
+        self._graph_t = torch.zeros(sample_shape[0], device=device, dtype=torch.long)
+        self._graph_cond = torch.zeros(cond_shape, device=device)
+        self._graph_inits = torch.zeros(inits_shape, device=device)
+        args = (self._graph_x, self._graph_t, self._graph_cond, self._graph_inits)
+
+        with torch.no_grad():
+            # warm up on a side stream so lazy initialisation is not recorded
+            stream = torch.cuda.Stream()
+            stream.wait_stream(torch.cuda.current_stream())
+            with torch.cuda.stream(stream):
+                for _ in range(3):
+                    self._forward(*args)
+            torch.cuda.current_stream().wait_stream(stream)
+
+            self._graph = torch.cuda.CUDAGraph()
+            with torch.cuda.graph(self._graph):
+                self._graph_out = self._forward(*args)
+
+    def forward_cond(self, x, time, cond, inits, cond_proj=None):
+        # equivalent to forward with cond_drop_prob=0.
+        if (exists(self._graph) and not torch.is_grad_enabled() and x.shape == self._graph_x.shape
+                and cond.shape == self._graph_cond.shape and inits.shape == self._graph_inits.shape):
+            self._graph_x.copy_(x)
+            self._graph_t.copy_(time)
+            self._graph_cond.copy_(cond)
+            self._graph_inits.copy_(inits)
+            self._graph.replay()
+            # the output buffer is overwritten by the next replay
+            return self._graph_out.clone()
+        return self._run(x, time, cond, inits, cond_proj)
+
+    def forward_null(self, x, time, cond, inits, cond_proj=None):
+        # equivalent to forward with cond_drop_prob=1., every row gets the null embedding (cond_proj is for the real cond and is ignored)
+        return self._run(x, time, self.null_classes_emb.expand(x.shape[0], -1), inits)
+
+    def enable_compile(self, mode='reduce-overhead', fullgraph=True):
+        # only the network is compiled, conditioning dropout runs eagerly in forward. fixed input shapes,
+        # a batch size that changes (sampling vs training, the doubled guided batch) compiles another graph
+        assert not self.script_modules, 'script_modules and torch.compile are alternatives, enable at most one'
+        self.compile_kwargs = dict(mode=mode, fullgraph=fullgraph, dynamic=False)
+
+    def _run(self, *args):
+        if exists(self.compile_kwargs):
+            return compiled(type(self)._forward, **self.compile_kwargs)(self, *args)
+        return self._forward(*args)
+
+    def _forward(self, x, time, cond, inits, cond_proj=None):
+        # inputs are cast once here so nothing below changes dtype mid-graph
+        c = cond.float()
+        proj = iter(default(cond_proj, (None,) * self.num_resnet_blocks))
+
+        # unet, in autocast_dtype when set; the output is returned in float32
+        # nullcontext rather than enabled=False, which would switch off an enclosing autocast (the sampler's sample_dtype)
+        with torch.autocast(device_type=x.device.type, dtype=self.autocast_dtype) if exists(self.autocast_dtype) else nullcontext():
+            x = self.init_conv(x.float())
+            r = x
+
+            t = self.time_mlp(time)
+            # i = self.inits_mlp(inits)
+            i = inits.float()
+
+            # skip connections in a fixed-size list written and read by index
+            h = [None] * (2 * len(self.downs))
+            for ind, (block1, block2, attn, downsample) in enumerate(self.downs):
+                x = block1(x, t, c, i, cond_proj=next(proj))
+                h[2 * ind] = x
+
+                x = block2(x, t, c, i, cond_proj=next(proj))
+                x = attn(x)
+                h[2 * ind + 1] = x
+
+                x = downsample(x)
+
+            x = self.mid_block1(x, t, c, i, cond_proj=next(proj))
+            x = self.mid_attn(x)
+            x = self.mid_block2(x, t, c, i, cond_proj=next(proj))
+
+            for ind, (block1, block2, attn, upsample) in enumerate(self.ups):
+                x = block1(x, t, c, i, cond_proj=next(proj), skip=h[-2 * ind - 1])
+
+                x = block2(x, t, c, i, cond_proj=next(proj), skip=h[-2 * ind - 2])
+                x = attn(x)
+
+                x = upsample(x)
+
+            x = self.final_res_block(x, t, c, i, cond_proj=next(proj), skip=r)
+            return self.final_conv(x).float()
@@ -9,7 +9,7 @@ setup(
     url='https://github.com/sisl/DiFS',
     packages=find_packages(),
     install_requires=[
-        'torch',
+        'torch>=2.0',
         'numpy',
         'einops',
         'accelerate',
@@ -6,7 +6,7 @@ import torch
 from torch.optim import Adam, AdamW
 from torch.utils.data import DataLoader
 
-from accelerate import Accelerator, DataLoaderConfiguration
+from accelerate import Accelerator, DataLoaderConfiguration, DistributedDataParallelKwargs
 from ema_pytorch import EMA
 
 from difs.diffusion import GaussianDiffusionConditional
@@ -51,6 +51,8 @@ class DiFS(object):
         wandb_plot_fn: Optional[Callable] = None,
         is_training: bool = True,
         save_intermediate: bool = False,
+        # multi-process runs only: the denoiser uses the same parameters every step, so DDP can treat the graph as static
+        ddp_static_graph: bool = True,
     ):
         super().__init__()
         self.init_disturbances = init_disturbances  # shape (N, 4, 24)
@@ -71,7 +73,8 @@ class DiFS(object):
         # accelerator
         self.accelerator = Accelerator(
             dataloader_config = DataLoaderConfiguration(split_batches=split_batches),
-            mixed_precision = mixed_precision_type if amp else 'no'
+            mixed_precision = mixed_precision_type if amp else 'no',
+            kwargs_handlers = [DistributedDataParallelKwargs(static_graph=ddp_static_graph, gradient_as_bucket_view=True)]
         )
 
         # model
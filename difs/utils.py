@@ -1,4 +1,5 @@
 import math
+from functools import lru_cache
 import torch
 from collections import namedtuple
 
@@ -12,6 +13,20 @@ def default(val, d):
         return val
     return d() if callable(d) else d
 
+@lru_cache(maxsize=None)
+def compiled(fn, **compile_kwargs):
+    # one torch.compile wrapper per (function, options), shared by every module instance that calls it with
+    # itself as the first argument. nothing is stored on the instance, so deepcopy (the EMA model) and pickling still work
+    return torch.compile(fn, **compile_kwargs)
+
+def raise_compile_cache_limit(entries):
+    # past cache_size_limit specialisations of one function, torch.compile silently runs the rest eagerly
+    import torch._dynamo
+    config = torch._dynamo.config
+    config.cache_size_limit = max(config.cache_size_limit, entries)
+    if hasattr(config, 'accumulated_cache_size_limit'):
+        config.accumulated_cache_size_limit = max(config.accumulated_cache_size_limit, entries)
+
 def identity(t, *args, **kwargs):
     return t
 